@@ -0,0 +1,67 @@
+"""Compare Arrow and row-by-row pandas -> Spark conversion on a generated sales CSV.
+
+Runs against a local Spark by default:
+
+    python bench_arrow.py --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault("SPARK_MASTER_URL", "local[*]")
+
+import server  # noqa: E402  (creates the SparkSession with the backend's settings)
+
+PRODUCTS = ["Apple", "Banana", "Orange", "Mango", "Grape", "Pineapple", "Durian", "Papaya"]
+
+
+def generate_sales_csv(path, rows, seed=42):
+    rng = np.random.default_rng(seed)
+    pd.DataFrame(
+        {
+            "id": np.arange(1, rows + 1),
+            "product": rng.choice(PRODUCTS, size=rows),
+            "amount": rng.integers(100, 5000, size=rows),
+        }
+    ).to_csv(path, index=False)
+
+
+def timed(label, build):
+    start = time.perf_counter()
+    df = build()
+    count = df.count()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<8} {elapsed:8.2f}s  ({count} rows)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sales.csv")
+        generate_sales_csv(path, args.rows)
+        pdf = pd.read_csv(path)
+
+    spark = server.spark_startup.connect()
+    spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+    schema = server._spark_schema_for(pdf)
+    # Warm up both paths so JVM startup is not charged to whichever runs first
+    sample = pdf.head(1000)
+    spark.createDataFrame(sample, schema=schema).count()
+    spark.createDataFrame(server._pandas_rows(sample), schema=schema).count()
+
+    print(f"Converting {len(pdf)} rows x {len(pdf.columns)} columns")
+    arrow = timed("arrow", lambda: spark.createDataFrame(pdf, schema=schema))
+    pickle = timed("pickle", lambda: spark.createDataFrame(server._pandas_rows(pdf), schema=schema))
+    print(f"speedup  {pickle / arrow:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
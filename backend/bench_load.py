@@ -0,0 +1,277 @@
+"""Load benchmark for the backend, built on the flow of test_e2e.py.
+
+Starts the backend with a local Spark (``local[*]``) unless --url points at a
+running one. It replays a weighted mix of uploads, queries and catalog calls
+at a fixed concurrency and reports p50/p95/p99 latency, requests per second
+and backend RSS (the API process plus its JVM). Results are written as JSON.
+The run fails when any request errors, or, if --baseline is given, when p95
+latency or throughput regress beyond --tolerance:
+
+    python bench_load.py --requests 500 --concurrency 8 --mix upload=1,query=8,tables=1,columns=1
+    python bench_load.py --baseline bench_results/previous.json
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+PRODUCTS = ["Apple", "Banana", "Orange", "Mango", "Grape", "Pineapple", "Durian", "Papaya"]
+QUERIES = [
+    "SELECT product, SUM(amount) AS total_sales FROM sales GROUP BY product ORDER BY total_sales DESC",
+    "SELECT COUNT(*) AS n, AVG(amount) AS avg_amount FROM sales",
+    "SELECT * FROM sales WHERE amount > 1000 ORDER BY amount DESC LIMIT 50",
+]
+
+
+def write_sales_csv(path, rows, seed):
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write("id,product,amount\n")
+        for i in range(1, rows + 1):
+            f.write(f"{i},{rng.choice(PRODUCTS)},{rng.randint(100, 5000)}\n")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {"upload", "query", "tables", "columns", "schema"}
+    if unknown:
+        raise SystemExit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def process_tree_rss(pid):
+    """Resident set size in bytes of ``pid`` and all of its descendants (Linux only)."""
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                stack.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid, self.interval = pid, interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.samples.append(process_tree_rss(self.pid))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.samples.append(process_tree_rss(self.pid))
+        return {"start": self.samples[0], "peak": max(self.samples), "end": self.samples[-1]}
+
+
+def start_backend(port, no_cache, state_dir):
+    # Durable tables, manifests and streamed uploads go to a scratch directory,
+    # so the run neither restores nor depends on the host's /data
+    env = dict(
+        os.environ,
+        SPARK_MASTER_URL="local[*]",
+        TABLE_STORE_DIR=os.path.join(state_dir, "tables"),
+        INGEST_DIR=os.path.join(state_dir, "uploads"),
+    )
+    if no_cache:
+        env["RESULT_CACHE_MAX_BYTES"] = "0"
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+
+
+def wait_until_up(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{url}/ready", timeout=10).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    raise SystemExit(f"Backend at {url} did not come up within {timeout}s")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_operation(url, name, csv_path, rng):
+    start = time.perf_counter()
+    try:
+        if name == "upload":
+            with open(csv_path, "rb") as f:
+                res = requests.post(f"{url}/upload", files={"file": ("sales.csv", f, "text/csv")})
+        elif name == "query":
+            res = requests.post(f"{url}/query", data={"query": rng.choice(QUERIES)})
+        elif name == "tables":
+            res = requests.get(f"{url}/tables")
+        elif name == "columns":
+            res = requests.get(f"{url}/columns", params={"table": "sales"})
+        else:
+            res = requests.get(f"{url}/schema")
+        ok = res.ok
+    except requests.RequestException:
+        ok = False
+    return name, time.perf_counter() - start, ok
+
+
+def summarize(latencies, errors, elapsed):
+    results = {}
+    for name, values in latencies.items():
+        results[name] = {
+            "count": len(values),
+            "errors": errors[name],
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "mean": sum(values) / len(values) if values else None,
+        }
+    everything = [v for values in latencies.values() for v in values]
+    overall = {
+        "count": len(everything),
+        "errors": sum(errors.values()),
+        "elapsedSeconds": elapsed,
+        "requestsPerSecond": len(everything) / elapsed if elapsed else None,
+        "p50": percentile(everything, 50),
+        "p95": percentile(everything, 95),
+        "p99": percentile(everything, 99),
+    }
+    return results, overall
+
+
+def find_regressions(report, baseline, tolerance):
+    regressions = []
+    for name, current in report["results"].items():
+        if current["errors"]:
+            # Failed requests are usually fast, so they would flatter latency and throughput
+            regressions.append(f"{name} {current['errors']}/{current['count']} requests failed")
+        before = baseline.get("results", {}).get(name)
+        if before and before.get("p95") and current["p95"] and current["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append(f"{name} p95 {current['p95']:.3f}s > baseline {before['p95']:.3f}s")
+    rps, base_rps = report["overall"]["requestsPerSecond"], baseline.get("overall", {}).get("requestsPerSecond")
+    if rps and base_rps and rps < base_rps * (1 - tolerance):
+        regressions.append(f"throughput {rps:.1f} req/s < baseline {base_rps:.1f} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running backend instead of starting one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mix", default="upload=1,query=8,tables=1,columns=1")
+    parser.add_argument("--rows", type=int, default=10000, help="rows in the uploaded sales CSV")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-cache", action="store_true", help="disable the /query result cache")
+    parser.add_argument("--output", help="JSON report path (default bench_results/load-<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    plan = rng.choices(list(mix), weights=list(mix.values()), k=args.requests)
+
+    backend = None
+    url = args.url
+    with tempfile.TemporaryDirectory() as tmp:
+        if url is None:
+            backend = start_backend(args.port, args.no_cache, tmp)
+            url = f"http://127.0.0.1:{args.port}"
+        try:
+            wait_until_up(url, timeout=180)
+            csv_path = os.path.join(tmp, "sales.csv")
+            write_sales_csv(csv_path, args.rows, args.seed)
+            # Queries and column lookups need the table to exist
+            _, _, ok = run_operation(url, "upload", csv_path, rng)
+            if not ok:
+                raise SystemExit("Seed upload of sales.csv failed; see the backend log")
+
+            sampler = RssSampler(backend.pid) if backend else None
+            if sampler:
+                sampler.start()
+            latencies = {name: [] for name in mix}
+            errors = {name: 0 for name in mix}
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                futures = [
+                    pool.submit(run_operation, url, name, csv_path, random.Random(args.seed + i))
+                    for i, name in enumerate(plan)
+                ]
+                for future in futures:
+                    name, latency, ok = future.result()
+                    latencies[name].append(latency)
+                    errors[name] += 0 if ok else 1
+            elapsed = time.perf_counter() - start
+            rss = sampler.stop() if sampler else None
+        finally:
+            if backend:
+                backend.terminate()
+                backend.wait(timeout=30)
+
+    results, overall = summarize(latencies, errors, elapsed)
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "results": results,
+        "overall": overall,
+        "rssBytes": rss,
+    }
+    output = args.output or os.path.join("bench_results", f"load-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, r in results.items():
+        if r["count"]:
+            print(f"{name:<8} n={r['count']:<5} err={r['errors']:<3} "
+                  f"p50={r['p50']:.3f}s p95={r['p95']:.3f}s p99={r['p99']:.3f}s")
+    print(f"overall  {overall['requestsPerSecond']:.1f} req/s over {elapsed:.1f}s")
+    if rss:
+        print(f"rss      start={rss['start'] / 2**20:.0f}MiB peak={rss['peak'] / 2**20:.0f}MiB")
+    print(f"report   {output}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    # Errors fail the run with or without a baseline
+    regressions = find_regressions(report, baseline, args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
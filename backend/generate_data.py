@@ -0,0 +1,124 @@
+"""Deterministic synthetic ``sales`` and ``products`` data at any scale.
+
+The columns match data/sales.csv and data/products.csv. As in init/init.sql,
+``sales.id`` is the key that joins to ``products.product_id``. It is drawn from
+the product key space with a Zipf-like skew (``--skew 0`` is uniform; larger
+values concentrate sales on a few hot products).
+
+Rows are generated in fixed-size chunks by a pool of worker processes. Each
+chunk has its own seed derived from ``--seed`` and the chunk number, so the
+output is identical whatever ``--workers`` is. Chunks are written as separate
+part files and never held together in memory:
+
+    python generate_data.py --sales-rows 100000000 --products 10000 --skew 1.1 --format parquet
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+NOUNS = [
+    "Apple", "Banana", "Orange", "Mango", "Laptop", "Mouse", "Coffee Maker", "Running Shoes",
+    "Backpack", "Headphones", "Desk Lamp", "Water Bottle", "Notebook", "Blender", "Yoga Mat", "Monitor",
+]
+CATEGORIES = ["Electronics", "Home Appliances", "Sportswear", "Groceries", "Office Supplies", "Accessories"]
+
+
+def product_names(ids: np.ndarray) -> pa.Array:
+    nouns = pc.take(pa.array(NOUNS), pa.array(ids % len(NOUNS)))
+    return pc.binary_join_element_wise(nouns, pa.array(ids).cast(pa.string()), " ")
+
+
+@lru_cache(maxsize=4)
+def key_cdf(products: int, skew: float) -> np.ndarray:
+    """Cumulative distribution over product keys 1..products, ~ 1 / rank**skew."""
+    weights = 1.0 / np.arange(1, products + 1, dtype=np.float64) ** skew
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def chunk_rng(seed: int, dataset: str, chunk: int) -> np.random.Generator:
+    return np.random.default_rng([seed, 0 if dataset == "sales" else 1, chunk])
+
+
+def sales_chunk(seed, chunk, rows, products, skew) -> pa.Table:
+    rng = chunk_rng(seed, "sales", chunk)
+    if skew > 0:
+        ids = np.searchsorted(key_cdf(products, skew), rng.random(rows)) + 1
+    else:
+        ids = rng.integers(1, products + 1, size=rows)
+    return pa.table({
+        "id": pa.array(ids, pa.int64()),
+        "product": product_names(ids),
+        "amount": pa.array(rng.integers(100, 5000, size=rows), pa.int64()),
+    })
+
+
+def products_chunk(seed, chunk, start, rows) -> pa.Table:
+    rng = chunk_rng(seed, "products", chunk)
+    ids = np.arange(start + 1, start + rows + 1)
+    names = product_names(ids)
+    categories = pc.take(pa.array(CATEGORIES), pa.array(ids % len(CATEGORIES)))
+    return pa.table({
+        "product_id": pa.array(ids, pa.int64()),
+        "product_name": names,
+        "category": categories,
+        "price": pa.array(np.round(rng.uniform(1, 2000, size=rows), 2)),
+        "stock_quantity": pa.array(rng.integers(0, 500, size=rows), pa.int64()),
+        "description": pc.binary_join_element_wise(pa.scalar("Synthetic"), names, " "),
+    })
+
+
+def write_chunk(dataset, chunk, start, rows, args) -> int:
+    if dataset == "sales":
+        table = sales_chunk(args.seed, chunk, rows, args.products, args.skew)
+    else:
+        table = products_chunk(args.seed, chunk, start, rows)
+    path = os.path.join(args.output, dataset, f"part-{chunk:05d}.{args.format}")
+    if args.format == "parquet":
+        pq.write_table(table, path, compression="zstd")
+    else:
+        pa_csv.write_csv(table, path)
+    return rows
+
+
+def generate(dataset, total_rows, args) -> None:
+    os.makedirs(os.path.join(args.output, dataset), exist_ok=True)
+    chunks = [
+        (chunk, start, min(args.chunk_rows, total_rows - start))
+        for chunk, start in enumerate(range(0, total_rows, args.chunk_rows))
+    ]
+    started = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(write_chunk, dataset, chunk, start, rows, args) for chunk, start, rows in chunks]
+        for future in futures:
+            done += future.result()
+    print(f"{dataset}: {done} rows in {len(chunks)} files ({time.perf_counter() - started:.1f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sales-rows", type=int, default=1_000_000)
+    parser.add_argument("--products", type=int, default=1000, help="number of products (join key space)")
+    parser.add_argument("--skew", type=float, default=0.0, help="Zipf exponent for sales.id; 0 is uniform")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--chunk-rows", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "generated"))
+    args = parser.parse_args()
+
+    generate("products", args.products, args)
+    generate("sales", args.sales_rows, args)
+
+
+if __name__ == "__main__":
+    main()
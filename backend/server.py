@@ -1,112 +1,3652 @@
+import asyncio
+import bisect
+import csv
+import fcntl
+import gzip
 import io
+import itertools
+import json
+import logging
 import os
-from typing import List
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Callable, Collection, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pyspark.sql import SparkSession
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from pyspark import StorageLevel
+from pyspark.sql import DataFrame, Row, SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql import types as T
+from pyspark.sql.pandas.types import to_arrow_schema
 import pandas as pd
+import zstandard
 from pydantic import BaseModel
 
 app = FastAPI()
+logger = logging.getLogger("uvicorn.error")
+slow_query_logger = logging.getLogger("uvicorn.error.slow_query")
 
 SPARK_MASTER_URL = os.getenv("SPARK_MASTER_URL", "spark://spark-master:7077")
+# When set (e.g. sc://spark-connect:15002), the backend is a Spark Connect client
+# instead of running its own driver. It joins the session SPARK_CONNECT_SESSION_ID
+# (a UUID, required, unique per deployment), so temp views outlive backend
+# restarts and every worker and replica of the deployment shares them.
+SPARK_CONNECT_URL = os.getenv("SPARK_CONNECT_URL", "")
+SPARK_CONNECT_SESSION_ID = os.getenv("SPARK_CONNECT_SESSION_ID", "")
+if SPARK_CONNECT_URL:
+    try:
+        uuid.UUID(SPARK_CONNECT_SESSION_ID)
+    except ValueError:
+        raise RuntimeError("SPARK_CONNECT_URL requires SPARK_CONNECT_SESSION_ID to be set to a UUID") from None
 RESULT_ROW_LIMIT = int(os.getenv("RESULT_ROW_LIMIT", "100"))
+# Serialized rows in a /query result stop at this many bytes (at least one row is
+# returned); 0 disables the budget
+RESULT_MAX_BYTES = int(os.getenv("RESULT_MAX_BYTES", str(4 * 1024 * 1024)))
+# Default /query result layout: "rows" (list of objects) or "columnar" (one array per column)
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "rows").lower()
+# /query results at least this large are zstd/gzip compressed when the client accepts it
+RESULT_COMPRESSION_MIN_BYTES = int(os.getenv("RESULT_COMPRESSION_MIN_BYTES", "1024"))
+HDFS_URL = os.getenv("HDFS_URL", "")
+# "memory" parses uploads with pandas on the backend; "stream" writes them to
+# shared storage in chunks and lets the executors parse the file.
+UPLOAD_INGEST_MODE = os.getenv("UPLOAD_INGEST_MODE", "memory").lower()
+# "local" uses INGEST_DIR (must be mounted at the same path on every Spark
+# container, e.g. /data); "hdfs" writes under INGEST_DIR on HDFS_URL.
+INGEST_STORAGE = os.getenv("INGEST_STORAGE", "local").lower()
+INGEST_DIR = os.getenv("INGEST_DIR", "/data/uploads")
+# Root for /ingest paths; must be mounted at the same path on every Spark container
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+# Rows sampled for CSV schema inference in /ingest
+INGEST_SAMPLE_ROWS = int(os.getenv("INGEST_SAMPLE_ROWS", "10000"))
+# Reuse the first inferred schema of a table on later ingests; on drift either
+# re-infer and replace it ("evolve") or reject the ingest ("reject")
+SCHEMA_REGISTRY_ENABLED = os.getenv("SCHEMA_REGISTRY_ENABLED", "true").lower() == "true"
+SCHEMA_DRIFT_POLICY = os.getenv("SCHEMA_DRIFT_POLICY", "evolve").lower()
+# Durable tables are written as Parquet under TABLE_STORE_DIR on the same
+# storage as INGEST_STORAGE, listed in a manifest and re-registered on startup
+TABLE_STORE_DIR = os.getenv("TABLE_STORE_DIR", "/data/tables")
+UPLOAD_DURABLE = os.getenv("UPLOAD_DURABLE", "false").lower() == "true"
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+SPARK_ARROW_ENABLED = os.getenv("SPARK_ARROW_ENABLED", "true").lower() == "true"
+# Storage level used to persist uploaded tables (e.g. MEMORY_AND_DISK); NONE disables
+UPLOAD_PERSIST_LEVEL = os.getenv("UPLOAD_PERSIST_LEVEL", "NONE").upper()
+SPARK_WORKER_THREADS = int(os.getenv("SPARK_WORKER_THREADS", "8"))
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "300"))
+# Byte budget for cached /query results; 0 disables the cache. Off by default
+# with Spark Connect, where other clients can change tables behind this one's back.
+RESULT_CACHE_MAX_BYTES = int(
+    os.getenv("RESULT_CACHE_MAX_BYTES", "0" if SPARK_CONNECT_URL else str(64 * 1024 * 1024))
+)
+QUERY_JOB_TTL_SECONDS = float(os.getenv("QUERY_JOB_TTL_SECONDS", "600"))
+QUERY_JOB_PROGRESS_INTERVAL_SECONDS = float(os.getenv("QUERY_JOB_PROGRESS_INTERVAL_SECONDS", "1"))
+# Rows per chunk written by /query/stream
+STREAM_BATCH_ROWS = int(os.getenv("STREAM_BATCH_ROWS", "1000"))
+# Spark job/stage metrics are read from the driver's REST API once a request's
+# job group finishes, after a short delay for the listener bus to catch up
+SPARK_METRICS_ENABLED = os.getenv("SPARK_METRICS_ENABLED", "true").lower() == "true" and not SPARK_CONNECT_URL
+SPARK_METRICS_DELAY_SECONDS = float(os.getenv("SPARK_METRICS_DELAY_SECONDS", "2"))
+# Uploads and queries slower than this are logged with their phase timings and
+# physical plan; 0 disables the slow-query log
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "5000"))
+# Catalog snapshots older than this are rebuilt to pick up tables created elsewhere
+CATALOG_SNAPSHOT_TTL_SECONDS = float(os.getenv("CATALOG_SNAPSHOT_TTL_SECONDS", "60"))
+CURSOR_IDLE_TTL_SECONDS = float(os.getenv("CURSOR_IDLE_TTL_SECONDS", "300"))
+MAX_OPEN_CURSORS = int(os.getenv("MAX_OPEN_CURSORS", "32"))
+CURSOR_MAX_PAGE_SIZE = int(os.getenv("CURSOR_MAX_PAGE_SIZE", "10000"))
+# Admission control in front of Spark work: at most MAX_CONCURRENT_QUERIES run
+# at once and at most MAX_QUERIES_PER_CLIENT per client (CLIENT_ID_HEADER, else
+# the client address). Others wait in a queue of ADMISSION_QUEUE_SIZE for up to
+# ADMISSION_MAX_WAIT_SECONDS; beyond that requests get 429.
+MAX_CONCURRENT_QUERIES = int(os.getenv("MAX_CONCURRENT_QUERIES", str(SPARK_WORKER_THREADS)))
+MAX_QUERIES_PER_CLIENT = int(os.getenv("MAX_QUERIES_PER_CLIENT", str(max(1, MAX_CONCURRENT_QUERIES // 2))))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "32"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "30"))
+CLIENT_ID_HEADER = os.getenv("CLIENT_ID_HEADER", "X-Client-Id")
+# Collect row counts, sizes and per-column min/max/distinct/null counts when a
+# table is registered. Cached tables are also ANALYZEd for the cost-based
+# optimizer; uncached tables estimated below TABLE_STATS_BROADCAST_BYTES get a
+# broadcast hint (0 disables hints), since temp views cannot hold statistics.
+TABLE_STATS_ENABLED = os.getenv("TABLE_STATS_ENABLED", "true").lower() == "true"
+TABLE_STATS_BROADCAST_BYTES = int(os.getenv("TABLE_STATS_BROADCAST_BYTES", str(10 * 1024 * 1024)))
+# Approximate queries (approx=true): the largest table referenced by a simple
+# SELECT is sampled down to about APPROX_SAMPLE_ROWS rows, and COUNT(DISTINCT x)
+# becomes a HyperLogLog estimate with this relative standard deviation
+APPROX_SAMPLE_ROWS = int(os.getenv("APPROX_SAMPLE_ROWS", "1000000"))
+APPROX_DISTINCT_RSD = float(os.getenv("APPROX_DISTINCT_RSD", "0.02"))
+# The SparkSession is created in the background after startup; until Spark
+# answers, Spark endpoints return 503 and /ready reports not ready
+SPARK_CONNECT_ATTEMPTS = int(os.getenv("SPARK_CONNECT_ATTEMPTS", "30"))
+SPARK_CONNECT_BACKOFF_SECONDS = float(os.getenv("SPARK_CONNECT_BACKOFF_SECONDS", "2"))
+# Run once before reporting ready so the first user query does not pay for
+# JVM code generation and JIT warm-up of scans, aggregation and collection; empty disables
+SPARK_WARMUP_QUERY = os.getenv(
+    "SPARK_WARMUP_QUERY",
+    "SELECT id % 100 AS k, count(*) AS n, sum(id) AS total FROM range(1000000) GROUP BY k ORDER BY k",
+)
+
+
+def _build_spark_session() -> SparkSession:
+    if SPARK_CONNECT_URL:
+        builder = SparkSession.builder.remote(f"{SPARK_CONNECT_URL.rstrip('/')}/;session_id={SPARK_CONNECT_SESSION_ID}")
+    else:
+        builder = SparkSession.builder.appName("CSVUploader").master(SPARK_MASTER_URL)
+    return (
+        builder
+        .config("spark.sql.execution.arrow.pyspark.enabled", str(SPARK_ARROW_ENABLED).lower())
+        # Fall back explicitly in _pandas_to_spark so the upload can report the path used
+        .config("spark.sql.execution.arrow.pyspark.fallback.enabled", "false")
+        .config("spark.sql.cbo.enabled", str(TABLE_STATS_ENABLED).lower())
+        .getOrCreate()
+    )
+
+
+def _spark_alive(session: SparkSession) -> bool:
+    """Whether ``session`` can run work: Connect answers, or the driver has executors."""
+    if SPARK_CONNECT_URL:
+        return bool(session.version)
+    jsc = session.sparkContext._jsc.sc()
+    if jsc.isStopped():
+        return False
+    # The driver registers itself as an executor; local masters need nothing else
+    return jsc.master().startswith("local") or len(jsc.statusTracker().getExecutorInfos()) > 1
+
+
+# Set by SparkStartup once Spark answers
+spark: Optional[SparkSession] = None
+
+
+class SparkStartup:
+    """Creates the SparkSession in the background, retrying with exponential backoff."""
+
+    def __init__(self, attempts: int, backoff_seconds: float):
+        self.max_attempts = attempts
+        self.backoff_seconds = backoff_seconds
+        self.state = "starting"
+        self.attempts = 0
+        self.error: Optional[str] = None
+        self.ready_at: Optional[float] = None
+        self.warmup_ms: Optional[float] = None
+        self._ready = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def connect(self) -> SparkSession:
+        global spark
+        for attempt in range(1, self.max_attempts + 1):
+            self.attempts = attempt
+            session = None
+            try:
+                session = _build_spark_session()
+                if not _spark_alive(session):
+                    raise RuntimeError("no executors registered with the Spark master yet")
+                spark, self.error = session, None
+                return session
+            except Exception as e:
+                self.error = str(e)
+                if session is not None:
+                    # getOrCreate() keeps returning a session whose context has been
+                    # stopped, so the next attempt must start from a fresh one
+                    try:
+                        session.stop()
+                    except Exception as stop_error:
+                        logger.debug("Could not stop Spark session: %s", stop_error)
+                logger.warning("Spark not available (attempt %d/%d): %s", attempt, self.max_attempts, e)
+                if attempt == self.max_attempts:
+                    self.state = "failed"
+                    raise
+                time.sleep(min(self.backoff_seconds * 2 ** (attempt - 1), 30))
+
+    def run(self) -> None:
+        try:
+            self.connect()
+        except Exception:
+            logger.error("Giving up on Spark after %d attempts", self.attempts)
+            return
+        self.state = "restoring"
+        try:
+            _restore_durable_tables()
+        except Exception as e:
+            logger.warning("Could not read durable table manifest: %s", e)
+        if SPARK_WARMUP_QUERY:
+            self.state = "warming"
+            start = time.perf_counter()
+            try:
+                spark.sql(SPARK_WARMUP_QUERY).collect()
+            except Exception as e:
+                logger.warning("Warm-up query failed: %s", e)
+            self.warmup_ms = (time.perf_counter() - start) * 1000
+        self.state, self.ready_at = "ready", time.time()
+        self._ready.set()
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "attempts": self.attempts,
+            "maxAttempts": self.max_attempts,
+            "error": self.error,
+            "readyAt": self.ready_at,
+            "warmupMs": self.warmup_ms,
+        }
+
+
+spark_startup = SparkStartup(SPARK_CONNECT_ATTEMPTS, SPARK_CONNECT_BACKOFF_SECONDS)
+
+# Spark calls block, so they run here instead of on the event loop. PySpark's
+# pinned thread mode (default since 3.2) keeps job groups per Python thread.
+spark_pool = ThreadPoolExecutor(max_workers=SPARK_WORKER_THREADS, thread_name_prefix="spark")
+
+# Held for the life of the process; see _claim_driver_lock
+_driver_lock = None
+
+
+def _claim_driver_lock():
+    """Without Spark Connect every process runs its own driver, whose tables,
+    jobs and cursors the others cannot see, so only one process may serve a
+    TABLE_STORE_DIR. A second uvicorn worker or replica fails to start."""
+    if INGEST_STORAGE == "hdfs":
+        path = os.path.join(tempfile.gettempdir(), "backend-driver.lock")
+    else:
+        path = _storage_uri("_driver.lock", root=TABLE_STORE_DIR)[len("file://"):]
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, "a")
+    except OSError as e:
+        # Like the manifests, the check is best-effort without a writable TABLE_STORE_DIR
+        logger.warning("Could not create %s, not checking for other backend processes: %s", path, e)
+        return None
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        raise RuntimeError(
+            "Another backend process already runs a Spark driver for TABLE_STORE_DIR; "
+            "run a single worker, or set SPARK_CONNECT_URL to share one session between workers"
+        ) from None
+    return f
+
+
+@app.on_event("startup")
+async def start_spark():
+    global _driver_lock
+    if not SPARK_CONNECT_URL:
+        _driver_lock = _claim_driver_lock()
+    # Not awaited: the API serves /ready (and 503s) while Spark comes up
+    spark_pool.submit(spark_startup.run)
+
+
+# Permissive CORS for demo; tighten in production
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["Server-Timing"],
+)
+
+REQUEST_LATENCY = Histogram(
+    "backend_request_duration_seconds", "HTTP request latency", ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+RESPONSE_BYTES = Histogram(
+    "backend_response_bytes", "HTTP response body size", ["route"],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216),
+)
+RESULT_ROWS = Histogram(
+    "backend_query_result_rows", "Rows returned per query", ["route"],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000),
+)
+UPLOAD_BYTES = Histogram(
+    "backend_upload_bytes", "Size of uploaded files", ["mode"],
+    buckets=(1024, 65536, 1048576, 16777216, 134217728, 536870912, 2147483648, 8589934592),
+)
+SPARK_JOBS = Counter("backend_spark_jobs_total", "Spark jobs run by requests", ["route", "status"])
+SPARK_STAGES = Counter("backend_spark_stages_total", "Spark stages run by requests", ["route", "status"])
+SPARK_TASKS = Counter("backend_spark_tasks_total", "Completed Spark tasks", ["route"])
+SPARK_TASK_SECONDS = Counter("backend_spark_task_run_seconds_total", "Executor run time of Spark tasks", ["route"])
+SPARK_STAGE_SECONDS = Histogram(
+    "backend_spark_stage_duration_seconds", "Wall-clock duration of Spark stages", ["route"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+SPARK_SHUFFLE_READ_BYTES = Counter("backend_spark_shuffle_read_bytes_total", "Shuffle bytes read", ["route"])
+SPARK_SHUFFLE_WRITE_BYTES = Counter("backend_spark_shuffle_write_bytes_total", "Shuffle bytes written", ["route"])
+SPARK_SPILL_BYTES = Counter("backend_spark_spill_bytes_total", "Bytes spilled by Spark tasks", ["route", "kind"])
+ADMISSION_RUNNING = Gauge("backend_admission_running", "Spark requests admitted and running")
+ADMISSION_QUEUE_DEPTH = Gauge("backend_admission_queue_depth", "Spark requests waiting for admission")
+ADMISSION_WAIT_SECONDS = Histogram(
+    "backend_admission_wait_seconds", "Time spent waiting for admission",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+ADMISSION_REJECTED = Counter("backend_admission_rejected_total", "Requests rejected by admission control", ["reason"])
+
+
+class RequestMetricsMiddleware:
+    """Latency and response size per route, taken when the response starts.
+
+    A plain ASGI middleware: Starlette's BaseHTTPMiddleware (``@app.middleware``)
+    hides client disconnects from ``request.is_disconnected()``, which request
+    cancellation and admission waits depend on.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        started = False
+
+        async def send_with_metrics(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                self._observe(scope, message["status"], start)
+                for name, value in message.get("headers", []):
+                    if name.lower() == b"content-length":
+                        RESPONSE_BYTES.labels(_route_of(scope)).observe(int(value))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        except Exception:
+            if not started:
+                self._observe(scope, 500, start)
+            raise
+
+    @staticmethod
+    def _observe(scope, status: int, start: float) -> None:
+        REQUEST_LATENCY.labels(scope["method"], _route_of(scope), str(status)).observe(time.perf_counter() - start)
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
+def _route_of(scope: dict) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+def _sanitize_table_name(name: str) -> str:
+    # Sanitize table name: letters, numbers, underscore only
+    table_name = "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+    return table_name or "uploaded_table"
+
+
+def _table_name_from(filename: str) -> str:
+    return _sanitize_table_name(os.path.splitext(os.path.basename(filename))[0])
+
+
+def _storage_uri(*parts: str, root: str = INGEST_DIR) -> str:
+    """Build a URI under ``root`` that every executor can resolve."""
+    path = "/".join([root.rstrip("/")] + list(parts))
+    if INGEST_STORAGE == "hdfs":
+        if not HDFS_URL:
+            raise RuntimeError("INGEST_STORAGE=hdfs requires HDFS_URL")
+        if SPARK_CONNECT_URL:
+            # Files on HDFS are managed through the driver JVM, which a Connect client does not have
+            raise RuntimeError("INGEST_STORAGE=hdfs is not supported with SPARK_CONNECT_URL")
+        return HDFS_URL.rstrip("/") + path
+    return "file://" + path
+
+
+def _hadoop_fs(uri: str):
+    jvm = spark._jvm
+    conf = spark._jsc.hadoopConfiguration()
+    return jvm.org.apache.hadoop.fs.FileSystem.get(jvm.java.net.URI(uri), conf)
+
+
+def _stream_to_storage(src, table_name: str) -> Optional[str]:
+    """Copy an upload to shared storage chunk by chunk.
+
+    Returns the URI of the written file, or None if the upload was empty.
+    """
+    uri = _storage_uri(table_name, f"{uuid.uuid4().hex}.csv")
+    written = 0
+    if INGEST_STORAGE == "hdfs":
+        jvm = spark._jvm
+        fs = _hadoop_fs(uri)
+        out = fs.create(jvm.org.apache.hadoop.fs.Path(uri), True)
+        try:
+            while chunk := src.read(UPLOAD_CHUNK_BYTES):
+                out.write(bytearray(chunk))
+                written += len(chunk)
+        finally:
+            out.close()
+        if not written:
+            fs.delete(jvm.org.apache.hadoop.fs.Path(uri), False)
+    else:
+        local_path = uri[len("file://"):]
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as out:
+            while chunk := src.read(UPLOAD_CHUNK_BYTES):
+                out.write(chunk)
+                written += len(chunk)
+        if not written:
+            os.remove(local_path)
+    return uri if written else None
+
+
+def _remove_siblings(dir_uri: str, keep: str) -> None:
+    """Delete every entry of ``dir_uri`` except the one named ``keep``."""
+    if INGEST_STORAGE == "hdfs":
+        jvm = spark._jvm
+        fs = _hadoop_fs(dir_uri)
+        if not fs.exists(jvm.org.apache.hadoop.fs.Path(dir_uri)):
+            return
+        for status in fs.listStatus(jvm.org.apache.hadoop.fs.Path(dir_uri)):
+            path = status.getPath()
+            if path.getName() != keep:
+                fs.delete(path, True)
+    else:
+        local_dir = dir_uri[len("file://"):]
+        if not os.path.isdir(local_dir):
+            return
+        for name in os.listdir(local_dir):
+            if name != keep:
+                path = os.path.join(local_dir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+
+def _remove_stale_uploads(table_name: str, keep: str) -> None:
+    """Delete earlier files of a table once its view points at ``keep``."""
+    _remove_siblings(_storage_uri(table_name), os.path.basename(keep))
+
+
+def _delete_uri(uri: str) -> None:
+    if INGEST_STORAGE == "hdfs":
+        _hadoop_fs(uri).delete(spark._jvm.org.apache.hadoop.fs.Path(uri), False)
+    else:
+        try:
+            os.remove(uri[len("file://"):])
+        except FileNotFoundError:
+            pass
+
+
+def _discard_upload(table_name: str, uri: str) -> None:
+    """Delete a streamed upload whose ingest failed, unless the table already reads it."""
+    try:
+        if uri in spark.table(table_name).inputFiles():
+            return
+    except Exception:
+        pass  # no such table
+    try:
+        _delete_uri(uri)
+    except Exception as e:
+        logger.warning("Could not delete failed upload %s: %s", uri, e)
+
+
+def _ingest_stored_upload(table_name: str, ingest_mode: str, source, *args) -> dict:
+    """_ingest_upload that cleans up a streamed file when the ingest fails."""
+    try:
+        return _ingest_upload(table_name, ingest_mode, source, *args)
+    except Exception:
+        if ingest_mode == "stream":
+            _discard_upload(table_name, source)
+        raise
+
+
+def _read_text(uri: str) -> Optional[str]:
+    if INGEST_STORAGE == "hdfs":
+        jvm = spark._jvm
+        fs = _hadoop_fs(uri)
+        path = jvm.org.apache.hadoop.fs.Path(uri)
+        if not fs.exists(path):
+            return None
+        stream = fs.open(path)
+        try:
+            return jvm.org.apache.commons.io.IOUtils.toString(stream, "UTF-8")
+        finally:
+            stream.close()
+    local_path = uri[len("file://"):]
+    if not os.path.exists(local_path):
+        return None
+    with open(local_path, encoding="utf-8") as f:
+        return f.read()
+
+
+def _write_text(uri: str, text: str) -> None:
+    if INGEST_STORAGE == "hdfs":
+        jvm = spark._jvm
+        fs = _hadoop_fs(uri)
+        out = fs.create(jvm.org.apache.hadoop.fs.Path(uri), True)
+        try:
+            out.write(bytearray(text.encode("utf-8")))
+        finally:
+            out.close()
+        return
+    local_path = uri[len("file://"):]
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    # Unique per writer, since other backend processes may write the same file
+    tmp_path = f"{local_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, local_path)
+
+
+@contextmanager
+def _file_lock(uri: str):
+    """Exclusive lock on ``uri`` + ".lock" across the backend processes sharing it.
+
+    Only local storage is locked; HDFS is only used by a single-process backend.
+    """
+    if not uri.startswith("file://"):
+        yield
+        return
+    lock_path = uri[len("file://"):] + ".lock"
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _shared_lock(*parts: str):
+    """A lock under TABLE_STORE_DIR held across workers in Spark Connect mode."""
+    return _file_lock(_storage_uri(*parts, root=TABLE_STORE_DIR)) if SPARK_CONNECT_URL else nullcontext()
+
+
+def _remove_shared_lock(*parts: str) -> None:
+    if SPARK_CONNECT_URL:
+        try:
+            os.remove(_storage_uri(*parts, root=TABLE_STORE_DIR)[len("file://"):] + ".lock")
+        except FileNotFoundError:
+            pass
+
+
+class SharedState(MutableMapping):
+    """A JSON object in a local file under TABLE_STORE_DIR, seen by every worker.
+
+    Reads reuse the parsed file until it is replaced; writes are
+    read-modify-write under a file lock.
+    """
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self._path = uri[len("file://"):]
+        self._cached: Tuple[Optional[tuple], dict] = (None, {})
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            f = open(self._path, encoding="utf-8")
+        except FileNotFoundError:
+            return {}
+        with f:
+            st = os.fstat(f.fileno())
+            signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+            with self._lock:
+                if self._cached[0] == signature:
+                    return self._cached[1]
+            data = json.loads(f.read() or "{}")
+        with self._lock:
+            self._cached = (signature, data)
+        return data
+
+    def modify(self, key: str, fn: Callable[[Optional[object]], Optional[object]]):
+        """Atomically replace the value of ``key`` with ``fn(current)``; None deletes it."""
+        with _file_lock(self.uri):
+            data = dict(self._load())
+            value = fn(data.get(key))
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+            _write_text(self.uri, json.dumps(data, sort_keys=True, default=str))
+        return value
+
+    def __getitem__(self, key: str):
+        return self._load()[key]
+
+    def __setitem__(self, key: str, value) -> None:
+        self.modify(key, lambda _: value)
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self._load():
+            raise KeyError(key)
+        self.modify(key, lambda _: None)
+
+    def __iter__(self):
+        return iter(list(self._load()))
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+
+def _shared_state(name: str) -> MutableMapping:
+    """State every worker must see: a SharedState in Spark Connect mode, where
+    several workers serve one session, else a plain dict of this process."""
+    return SharedState(_storage_uri(name, root=TABLE_STORE_DIR)) if SPARK_CONNECT_URL else {}
+
+
+def _spark_type_for(dtype) -> Optional[T.DataType]:
+    if pd.api.types.is_bool_dtype(dtype):
+        return T.BooleanType()
+    if pd.api.types.is_integer_dtype(dtype):
+        return {1: T.ByteType(), 2: T.ShortType(), 4: T.IntegerType()}.get(dtype.itemsize, T.LongType())
+    if pd.api.types.is_float_dtype(dtype):
+        return T.FloatType() if dtype.itemsize == 4 else T.DoubleType()
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return T.TimestampType()
+    if pd.api.types.is_string_dtype(dtype) or pd.api.types.is_object_dtype(dtype):
+        return T.StringType()
+    return None
+
+
+def _spark_schema_for(pdf: pd.DataFrame) -> Optional[T.StructType]:
+    """Map pandas dtypes to an explicit Spark schema, or None if any dtype is unknown."""
+    fields = []
+    for name, dtype in pdf.dtypes.items():
+        spark_type = _spark_type_for(dtype)
+        if spark_type is None:
+            return None
+        fields.append(T.StructField(str(name), spark_type, True))
+    return T.StructType(fields)
+
+
+def _pandas_rows(pdf: pd.DataFrame) -> List[tuple]:
+    """Plain Python rows (NaN -> None) for the non-Arrow createDataFrame path."""
+    boxed = pdf.astype(object).where(pdf.notna(), None)
+    return list(boxed.itertuples(index=False, name=None))
+
+
+def _pandas_to_spark(pdf: pd.DataFrame) -> Tuple[DataFrame, str]:
+    """Convert with Arrow when possible, falling back to row-by-row pickling.
+
+    Returns the DataFrame and the conversion path used ("arrow" or "pickle").
+    """
+    schema = _spark_schema_for(pdf)
+    if SPARK_ARROW_ENABLED:
+        try:
+            return spark.createDataFrame(pdf, schema=schema), "arrow"
+        except Exception:
+            pass
+    rows = _pandas_rows(pdf)
+    if schema is None:
+        # Without a schema createDataFrame(pdf) would try Arrow again, so columns of
+        # unmapped dtypes are passed as strings instead
+        types = [_spark_type_for(dtype) for dtype in pdf.dtypes]
+        schema = T.StructType([
+            T.StructField(str(name), spark_type or T.StringType(), True)
+            for name, spark_type in zip(pdf.columns, types)
+        ])
+        strings = {i for i, spark_type in enumerate(types) if spark_type is None}
+        rows = [
+            tuple(str(v) if i in strings and v is not None else v for i, v in enumerate(row))
+            for row in rows
+        ]
+    return spark.createDataFrame(rows, schema=schema), "pickle"
+
+
+class PhaseTimer:
+    """Wall-clock time per named phase of a request, for Server-Timing and the slow-query log."""
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = []
+        self.df: Optional[DataFrame] = None  # whose physical plan goes into the slow-query log
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, (time.perf_counter() - start) * 1000))
+
+    def total_ms(self) -> float:
+        return sum(ms for _, ms in self.phases)
+
+    def header(self) -> str:
+        return ", ".join(f"{name};dur={ms:.1f}" for name, ms in self.phases + [("total", self.total_ms())])
+
+
+def _log_slow(kind: str, timer: PhaseTimer, sql: Optional[str] = None, table: Optional[str] = None) -> None:
+    plan = None
+    if timer.df is not None:
+        try:
+            plan = timer.df._jdf.queryExecution().executedPlan().toString()
+        except Exception as e:
+            plan = f"<unavailable: {e}>"
+    slow_query_logger.warning(json.dumps({
+        "event": "slow_query",
+        "kind": kind,
+        "sql": sql,
+        "table": table,
+        "totalMs": round(timer.total_ms(), 1),
+        "phasesMs": {name: round(ms, 1) for name, ms in timer.phases},
+        "plan": plan,
+    }))
+
+
+async def _finish_timing(response: Response, timer: PhaseTimer, kind: str, **context) -> None:
+    response.headers["Server-Timing"] = timer.header()
+    if SLOW_QUERY_THRESHOLD_MS and timer.total_ms() >= SLOW_QUERY_THRESHOLD_MS:
+        await run_in_threadpool(_log_slow, kind, timer, **context)
+
+
+class SparkJobCancelled(Exception):
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SparkNotReady(SparkJobCancelled):
+    def __init__(self):
+        super().__init__(f"Spark is not ready ({spark_startup.state})", 503)
+
+
+def _require_spark() -> None:
+    if not spark_startup.ready:
+        raise SparkNotReady()
+
+
+class AdmissionRejected(SparkJobCancelled):
+    def __init__(self, message: str, reason: str):
+        super().__init__(message, 429)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Concurrency caps for Spark work, global and per client, with a bounded FIFO queue.
+
+    Runs on the event loop only, so no locking is needed. A waiter is admitted
+    as soon as both its client and the global cap have room; waiters whose
+    client is at its quota do not block other clients behind them.
+    """
+
+    def __init__(self, max_running: int, per_client: int, max_queued: int, max_wait: float):
+        self.max_running = max_running
+        self.per_client = per_client
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.running = 0
+        self._by_client: Dict[str, int] = {}
+        self._waiters: List[Tuple[str, asyncio.Future]] = []
+
+    def _has_room(self, client: str) -> bool:
+        return self.running < self.max_running and self._by_client.get(client, 0) < self.per_client
+
+    def _take(self, client: str) -> None:
+        self.running += 1
+        self._by_client[client] = self._by_client.get(client, 0) + 1
+        ADMISSION_RUNNING.set(self.running)
+
+    def _grant(self) -> None:
+        for client, future in list(self._waiters):
+            if self.running >= self.max_running:
+                break
+            if not future.done() and self._has_room(client):
+                self._waiters.remove((client, future))
+                self._take(client)
+                future.set_result(None)
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+
+    def enqueue(self, client: str) -> asyncio.Future:
+        """Take a slot or a queue position; raises AdmissionRejected if the queue is full."""
+        future = asyncio.get_running_loop().create_future()
+        if self._has_room(client):
+            self._take(client)
+            future.set_result(None)
+        elif len(self._waiters) >= self.max_queued:
+            ADMISSION_REJECTED.labels("queue_full").inc()
+            raise AdmissionRejected("Too many queued queries, retry later", "queue_full")
+        else:
+            self._waiters.append((client, future))
+            ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+        return future
+
+    async def wait(self, client: str, future: asyncio.Future, disconnected: Optional[asyncio.Future] = None) -> None:
+        """Wait until an enqueued request is admitted, the wait times out or the client leaves."""
+        start = time.perf_counter()
+        try:
+            if not future.done():
+                await asyncio.wait({future} | ({disconnected} if disconnected else set()), timeout=self.max_wait,
+                                   return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(client)
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+                self._waiters.remove((client, future))
+                ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start)
+        if future.cancelled():
+            if disconnected is not None and disconnected.done():
+                raise SparkJobCancelled("Client disconnected", 499)
+            ADMISSION_REJECTED.labels("timeout").inc()
+            raise AdmissionRejected(f"Not admitted within {self.max_wait:g}s, retry later", "timeout")
+
+    async def admit(self, client: str, disconnected: Optional[asyncio.Future] = None) -> None:
+        await self.wait(client, self.enqueue(client), disconnected)
+
+    def release(self, client: str) -> None:
+        self.running -= 1
+        remaining = self._by_client.get(client, 1) - 1
+        if remaining:
+            self._by_client[client] = remaining
+        else:
+            self._by_client.pop(client, None)
+        ADMISSION_RUNNING.set(self.running)
+        self._grant()
+
+
+admission = AdmissionController(
+    MAX_CONCURRENT_QUERIES, MAX_QUERIES_PER_CLIENT, ADMISSION_QUEUE_SIZE, ADMISSION_MAX_WAIT_SECONDS
+)
+
+
+def _client_id(request: Request) -> str:
+    return request.headers.get(CLIENT_ID_HEADER) or (request.client.host if request.client else "unknown")
+
+
+async def _wait_for_disconnect(request: Request, poll_seconds: float = 0.5) -> None:
+    while not await request.is_disconnected():
+        await asyncio.sleep(poll_seconds)
+
+
+@contextmanager
+def _job_group(group_id: str, description: str):
+    """Tag Spark work started by this thread so it can be cancelled as a group.
+
+    Classic sessions use a job group; Spark Connect has no SparkContext and
+    uses an operation tag instead.
+    """
+    if SPARK_CONNECT_URL:
+        spark.addTag(group_id)
+        try:
+            yield
+        finally:
+            spark.removeTag(group_id)
+        return
+    sc = spark.sparkContext
+    sc.setJobGroup(group_id, description, interruptOnCancel=True)
+    try:
+        yield
+    finally:
+        sc.setLocalProperty("spark.jobGroup.id", None)
+        sc.setLocalProperty("spark.job.description", None)
+
+
+def _cancel_group(group_id: str) -> None:
+    if SPARK_CONNECT_URL:
+        spark.interruptTag(group_id)
+    else:
+        spark.sparkContext.cancelJobGroup(group_id)
+
+
+def _in_job_group(group_id: str, description: str, fn, *args):
+    with _job_group(group_id, description):
+        return fn(*args)
+
+
+def _spark_rest(path: str):
+    sc = spark.sparkContext
+    if not sc.uiWebUrl:
+        return None
+    url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}{path}"
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.load(response)
+
+
+def _spark_time(value: str) -> datetime:
+    return datetime.strptime(value.replace("GMT", "+0000"), "%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+def _observe_spark_group(group_id: str, route: str) -> None:
+    """Export job, stage, task, shuffle and spill numbers of one job group."""
+    for job_id in spark.sparkContext.statusTracker().getJobIdsForGroup(group_id):
+        job = _spark_rest(f"/jobs/{job_id}")
+        if not job:
+            continue
+        SPARK_JOBS.labels(route, job["status"]).inc()
+        for stage_id in job["stageIds"]:
+            try:
+                attempts = _spark_rest(f"/stages/{stage_id}") or []
+            except Exception:
+                continue  # skipped stages are not always retained
+            for stage in attempts:
+                SPARK_STAGES.labels(route, stage["status"]).inc()
+                SPARK_TASKS.labels(route).inc(stage.get("numCompleteTasks", 0))
+                SPARK_TASK_SECONDS.labels(route).inc(stage.get("executorRunTime", 0) / 1000)
+                SPARK_SHUFFLE_READ_BYTES.labels(route).inc(stage.get("shuffleReadBytes", 0))
+                SPARK_SHUFFLE_WRITE_BYTES.labels(route).inc(stage.get("shuffleWriteBytes", 0))
+                SPARK_SPILL_BYTES.labels(route, "memory").inc(stage.get("memoryBytesSpilled", 0))
+                SPARK_SPILL_BYTES.labels(route, "disk").inc(stage.get("diskBytesSpilled", 0))
+                if stage.get("submissionTime") and stage.get("completionTime"):
+                    duration = _spark_time(stage["completionTime"]) - _spark_time(stage["submissionTime"])
+                    SPARK_STAGE_SECONDS.labels(route).observe(duration.total_seconds())
+
+
+def _observe_spark_group_later(group_id: str, route: str) -> None:
+    if not SPARK_METRICS_ENABLED:
+        return
+
+    def observe():
+        try:
+            _observe_spark_group(group_id, route)
+        except Exception as e:
+            logger.debug("Could not collect Spark metrics for %s: %s", group_id, e)
+
+    timer = threading.Timer(SPARK_METRICS_DELAY_SECONDS, observe)
+    timer.daemon = True
+    timer.start()
+
+
+async def run_spark(request: Request, description: str, fn, *args, group_id: Optional[str] = None):
+    """Run blocking Spark work in the worker pool under its own job group.
+
+    The work first waits for admission. The job group (by default one per
+    request) is cancelled if the client disconnects or the request runs
+    longer than REQUEST_TIMEOUT_SECONDS, so abandoned queries free their cores.
+    """
+    _require_spark()
+    group_id = group_id or f"req-{uuid.uuid4().hex}"
+    loop = asyncio.get_running_loop()
+    client = _client_id(request)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        await admission.admit(client, watcher)
+        try:
+            work = loop.run_in_executor(spark_pool, _in_job_group, group_id, description, fn, *args)
+            done, _ = await asyncio.wait(
+                {work, watcher}, timeout=REQUEST_TIMEOUT_SECONDS, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            admission.release(client)
+    finally:
+        watcher.cancel()
+    _observe_spark_group_later(group_id, _route_of(request.scope))
+    if work in done:
+        return work.result()
+
+    work.cancel()
+    _cancel_group(group_id)
+    if watcher in done:
+        raise SparkJobCancelled("Client disconnected", 499)
+    raise SparkJobCancelled(f"Request timed out after {REQUEST_TIMEOUT_SECONDS:g}s", 504)
+
+
+_SQL_LITERAL = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")")
+_SQL_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_SQL_IDENTIFIER = re.compile(r"[a-z_][a-z0-9_]*")
+_NONDETERMINISTIC = re.compile(
+    r"\b(rand|randn|random|uuid|shuffle|now|current_date|current_timestamp|unix_timestamp|localtimestamp)\b"
+)
+
+
+def normalize_sql(query: str) -> str:
+    """Lowercase and collapse whitespace outside string literals, drop comments."""
+    parts = []
+    for i, part in enumerate(_SQL_LITERAL.split(query)):
+        if i % 2:
+            parts.append(part)
+        else:
+            parts.append(" ".join(_SQL_COMMENT.sub(" ", part).lower().split()))
+    return " ".join(p for p in parts if p).strip().rstrip(";").strip()
+
+
+class ResultCache:
+    """LRU cache of query results under a byte budget.
+
+    Entries are keyed on the normalized SQL plus the version of every table the
+    query may read. Any identifier in the query is treated as a possible table,
+    which over-approximates dependencies. Views defined in SQL hide the tables
+    they read, so queries naming a view the backend did not register itself are
+    not cached. Versions, managed tables and the epoch live in ``state``, which
+    workers sharing a Spark Connect session share too.
+    """
+
+    # Key in ``state`` of the epoch bumped by clear(); never a table name
+    _EPOCH = ""
+
+    def __init__(self, max_bytes: int, state: Optional[MutableMapping] = None):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, Tuple[dict, int, frozenset]]" = OrderedDict()
+        # Table name -> [version, managed]; managed tables and views are the
+        # ones registered by the backend, which invalidates them on change
+        self._state = {} if state is None else state
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key_for(self, query: str, views: Callable[[], Collection[str]] = tuple) -> Optional[tuple]:
+        """Cache key for ``query``, or None if it cannot be cached.
+
+        ``views`` returns the lowercase names of the views in the catalog; it is
+        only called for cacheable queries.
+        """
+        if self.max_bytes <= 0:
+            return None
+        sql = normalize_sql(query)
+        if not sql.startswith(("select", "with")) or _NONDETERMINISTIC.search(sql):
+            return None
+        deps = frozenset(_SQL_IDENTIFIER.findall(_SQL_LITERAL.sub("", sql)))
+        with self._lock:
+            state = {t: self._state.get(t, (0, False)) for t in deps}
+            epoch = self._epoch()
+        unmanaged = {t for t, (_, managed) in state.items() if not managed}
+        if unmanaged and unmanaged & set(views()):
+            return None
+        return sql, tuple(sorted((t, version) for t, (version, _) in state.items())), epoch
+
+    def _epoch(self) -> int:
+        return self._state.get(self._EPOCH, (0, False))[0]
+
+    def _version(self, table: str) -> int:
+        return self._state.get(table, (0, False))[0]
+
+    def get(self, key: tuple) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: tuple, result: dict, size: Optional[int] = None) -> None:
+        """Cache ``result``; ``size`` is its serialized length if already known."""
+        if size is None:
+            size = len(json.dumps(result, default=str))
+        if size > self.max_bytes:
+            return
+        deps = frozenset(t for t, _ in key[1])
+        with self._lock:
+            if key[2] != self._epoch() or any(self._version(t) != v for t, v in key[1]):
+                return  # a table changed while the query ran
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size, deps)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, table: str) -> None:
+        """Bump a table's version and drop only the entries that read it."""
+        self._bump(table.lower(), managed=True)
+        self._drop_entries(table.lower())
+
+    def _bump(self, name: str, managed: bool) -> None:
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            if isinstance(self._state, SharedState):
+                self._state.modify(name, lambda current: [(current or [0])[0] + 1, managed])
+            else:
+                self._state[name] = [self._state.get(name, (0, False))[0] + 1, managed]
+
+    def _drop_entries(self, table: str) -> None:
+        with self._lock:
+            for key in [k for k, (_, _, deps) in self._entries.items() if table in deps]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def forget(self, table: str) -> None:
+        """Invalidate a dropped table; a view later created under its name is unmanaged."""
+        self._bump(table.lower(), managed=False)
+        self._drop_entries(table.lower())
+
+    def clear(self) -> None:
+        self._bump(self._EPOCH, managed=False)
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, _shared_state("_cache_versions.json"))
+
+
+def _catalog_views() -> List[str]:
+    """Lowercase names of temporary and persistent views in the current database."""
+    return [t.name.lower() for t in spark.catalog.listTables() if t.tableType in ("TEMPORARY", "VIEW")]
+
+
+SQL_KEYWORDS = [
+    "SELECT", "FROM", "WHERE", "GROUP BY", "ORDER BY", "JOIN", "LEFT JOIN", "RIGHT JOIN", "INNER JOIN", "FULL JOIN",
+    "ON", "AS", "LIMIT", "OFFSET", "AND", "OR", "NOT", "BETWEEN", "LIKE", "IN", "IS NULL", "IS NOT NULL",
+    "HAVING", "DISTINCT", "COUNT", "SUM", "AVG", "MIN", "MAX", "CAST", "CASE", "WHEN", "THEN", "ELSE", "END",
+    "UNION", "UNION ALL", "DESC", "ASC",
+]
+
+
+class CatalogIndex:
+    """Cached snapshot of tables and columns with a prefix index for autocompletion.
+
+    Uploads update their table in place; anything else that may change the
+    catalog marks the snapshot dirty. Reads are served from memory, so callers
+    refresh() a stale snapshot first; only the rebuild talks to Spark.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._tables: Dict[str, dict] = {}
+        self._index: List[Tuple[str, str, str, Optional[str]]] = []
+        self._built_at = 0.0
+        self._dirty = True
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        self._dirty = True
+
+    def put_table(self, name: str, dtypes: List[Tuple[str, str]]) -> None:
+        with self._lock:
+            if self._dirty:
+                return  # the next rebuild picks it up
+            self._tables[name] = {
+                "name": name,
+                "database": None,
+                "isTemporary": True,
+                "columns": [{"name": c, "type": t} for c, t in dtypes],
+            }
+            self._reindex()
+
+    def _reindex(self) -> None:
+        index = [(k.lower(), "keyword", k, None) for k in SQL_KEYWORDS]
+        for table in self._tables.values():
+            index.append((table["name"].lower(), "table", table["name"], table["database"]))
+            for col in table["columns"]:
+                index.append((col["name"].lower(), "column", col["name"], table["name"]))
+        index.sort(key=lambda e: (e[0], e[1], e[2], e[3] or ""))
+        self._index = index
+
+    def _rebuild(self) -> None:
+        tables = {}
+        for t in spark.catalog.listTables():
+            qualified = t.name if t.isTemporary or not t.database else f"{t.database}.{t.name}"
+            try:
+                columns = [{"name": c, "type": dt} for c, dt in spark.table(qualified).dtypes]
+            except Exception:
+                columns = []
+            tables[t.name] = {
+                "name": t.name,
+                "database": t.database,
+                "isTemporary": t.isTemporary,
+                "columns": columns,
+            }
+        with self._lock:
+            self._tables = tables
+            self._reindex()
+            self._built_at = time.time()
+            self._dirty = False
+
+    @property
+    def stale(self) -> bool:
+        return self._dirty or time.time() - self._built_at > self.ttl_seconds
+
+    def refresh(self) -> None:
+        if self.stale:
+            self._rebuild()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"tables": list(self._tables.values()), "builtAt": self._built_at}
+
+    def complete(self, prefix: str, kind: Optional[str] = None, limit: int = 50) -> dict:
+        matches = []
+        with self._lock:
+            if "." in prefix:
+                table_name, col_prefix = prefix.split(".", 1)
+                table = self._tables.get(table_name)
+                for col in table["columns"] if table else []:
+                    if col["name"].lower().startswith(col_prefix.lower()):
+                        matches.append({"type": "column", "value": f"{table_name}.{col['name']}", "detail": table_name})
+                        if len(matches) >= limit:
+                            break
+            else:
+                needle = prefix.lower()
+                for key, entry_kind, value, detail in self._index[bisect.bisect_left(self._index, (needle,)):]:
+                    if not key.startswith(needle) or len(matches) >= limit:
+                        break
+                    if kind is None or kind == entry_kind:
+                        matches.append({"type": entry_kind, "value": value, "detail": detail})
+        return {"prefix": prefix, "suggestions": matches}
+
+
+catalog_index = CatalogIndex(CATALOG_SNAPSHOT_TTL_SECONDS)
+
+
+# Uploaded tables persisted in executor storage (name -> storage level), and
+# row counts known from ingest
+_persisted_tables: MutableMapping = _shared_state("_persisted.json")
+_table_row_counts: MutableMapping = _shared_state("_row_counts.json")
+# Row counts estimated from file sizes for tables registered without a count
+_table_row_estimates: MutableMapping = _shared_state("_row_estimates.json")
+# Statistics collected at registration (name -> table and column stats)
+_table_stats: MutableMapping = _shared_state("_table_stats.json")
+
+
+def _storage_level(name: str) -> Optional[StorageLevel]:
+    level = getattr(StorageLevel, name.upper(), None)
+    return level if isinstance(level, StorageLevel) else None
+
+
+class JsonManifest:
+    """JSON file on shared storage mapping table names to entries."""
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, dict]:
+        text = _read_text(self.uri)
+        return json.loads(text) if text else {}
+
+    def put(self, table: str, entry: dict) -> None:
+        with self._lock, _file_lock(self.uri):
+            tables = self.load()
+            tables[table] = entry
+            _write_text(self.uri, json.dumps(tables, indent=2, sort_keys=True))
+
+    def remove(self, table: str) -> Optional[dict]:
+        with self._lock, _file_lock(self.uri):
+            tables = self.load()
+            entry = tables.pop(table, None)
+            if entry is not None:
+                _write_text(self.uri, json.dumps(tables, indent=2, sort_keys=True))
+            return entry
+
+
+# Durable Parquet tables: name -> path, schema and row count
+table_manifest = JsonManifest(_storage_uri("_manifest.json", root=TABLE_STORE_DIR))
+# Schema registry: name -> schema reused on later ingests of the same table
+schema_registry = JsonManifest(_storage_uri("_schemas.json", root=TABLE_STORE_DIR))
+
+
+class SchemaDriftError(Exception):
+    def __init__(self, table: str, drift: dict):
+        super().__init__(f"Schema of '{table}' drifted from the registered schema")
+        self.drift = drift
+
+
+_NUMERIC_RANK = {
+    T.ByteType: 1, T.ShortType: 2, T.IntegerType: 3, T.LongType: 4, T.FloatType: 5, T.DoubleType: 6,
+}
+
+
+def _type_compatible(observed: T.DataType, registered: T.DataType) -> bool:
+    """Whether values of ``observed`` type can be cast to ``registered`` without loss."""
+    if observed == registered or isinstance(registered, T.StringType):
+        return True
+    observed_rank = _NUMERIC_RANK.get(type(observed))
+    registered_rank = _NUMERIC_RANK.get(type(registered))
+    return bool(observed_rank and registered_rank and observed_rank <= registered_rank)
+
+
+_INTEGRAL_RANGE = {
+    T.ByteType: (-(2 ** 7), 2 ** 7 - 1),
+    T.ShortType: (-(2 ** 15), 2 ** 15 - 1),
+    T.IntegerType: (-(2 ** 31), 2 ** 31 - 1),
+    T.LongType: (-(2 ** 63), 2 ** 63 - 1),
+}
+
+
+def _values_fit(column: pd.Series, registered: T.DataType) -> bool:
+    """Whether the values of a pandas column cast to ``registered`` without loss.
+
+    pandas reads every integer column as int64 (float64 with nulls) and dates
+    as strings, where Spark's CSV inference picks the narrowest integer type
+    and DateType/TimestampType, so dtypes alone would report drift on every
+    upload of a table first registered through /ingest or stream mode.
+    """
+    values = column.dropna()
+    bounds = _INTEGRAL_RANGE.get(type(registered))
+    if bounds is not None:
+        if pd.api.types.is_bool_dtype(values.dtype) or not pd.api.types.is_numeric_dtype(values.dtype):
+            return False
+        if pd.api.types.is_float_dtype(values.dtype) and not (values == values.round()).all():
+            return False
+        return bool(bounds[0] <= values.min() and values.max() <= bounds[1])
+    if isinstance(registered, (T.DateType, T.TimestampType)) and not pd.api.types.is_numeric_dtype(values.dtype):
+        return bool(pd.to_datetime(values, errors="coerce", format="ISO8601").notna().all())
+    return False
+
+
+# The registry is best-effort: uploads must not fail because TABLE_STORE_DIR is
+# unavailable, they only lose schema reuse and drift checks
+
+
+def _registered_schema(table_name: str) -> Optional[T.StructType]:
+    if not SCHEMA_REGISTRY_ENABLED:
+        return None
+    try:
+        entry = schema_registry.load().get(table_name)
+    except Exception as e:
+        logger.warning("Could not read the schema registry: %s", e)
+        return None
+    return T.StructType.fromJson(json.loads(entry["schema"])) if entry else None
+
+
+def _register_schema(table_name: str, schema: T.StructType) -> None:
+    if not SCHEMA_REGISTRY_ENABLED:
+        return
+    try:
+        schema_registry.put(table_name, {"schema": schema.json(), "updatedAt": time.time()})
+    except Exception as e:
+        logger.warning("Could not register the schema of %s: %s", table_name, e)
+
+
+def _column_drift(observed: List[str], registered: List[str]) -> Optional[dict]:
+    if observed == registered:
+        return None
+    added = [c for c in observed if c not in registered]
+    removed = [c for c in registered if c not in observed]
+    return {"added": added, "removed": removed, "reordered": not added and not removed}
+
+
+def _pandas_drift(pdf: pd.DataFrame, registered: T.StructType) -> Optional[dict]:
+    drift = _column_drift([str(c) for c in pdf.columns], registered.fieldNames())
+    if drift:
+        return drift
+    changed = []
+    for field in registered.fields:
+        column = pdf[field.name]
+        observed = _spark_type_for(column.dtype)
+        # All-null columns come back as float64 and fit any registered type
+        if column.isna().all() or (observed is not None and _type_compatible(observed, field.dataType)):
+            continue
+        if _values_fit(column, field.dataType):
+            continue
+        changed.append({"column": field.name, "registered": field.dataType.simpleString(), "observed": str(column.dtype)})
+    return {"typeChanged": changed} if changed else None
+
+
+def _csv_sample(uri: str) -> List[str]:
+    """The first INGEST_SAMPLE_ROWS lines of a file, directory or glob."""
+    # collect() on a limit only scans as many partitions as it needs
+    return [row.value for row in spark.read.text(uri).limit(INGEST_SAMPLE_ROWS).collect()]
+
+
+@contextmanager
+def _csv_lines(lines: List[str]):
+    """Something ``spark.read.csv`` accepts that holds ``lines``.
+
+    Spark Connect readers only take paths, so there the lines go through a
+    scratch file on shared storage that is removed afterwards.
+    """
+    if not SPARK_CONNECT_URL:
+        yield spark.sparkContext.parallelize(lines, 1)
+        return
+    uri = _storage_uri("_samples", f"{uuid.uuid4().hex}.csv")
+    _write_text(uri, "\n".join(lines) + "\n")
+    try:
+        yield uri
+    finally:
+        os.remove(uri[len("file://"):])
+
+
+def _csv_drift(lines: List[str], registered: T.StructType) -> Optional[dict]:
+    """Compare a sample's header with the registered schema and parse it with that schema."""
+    header = next(csv.reader(lines[:1]), [])
+    drift = _column_drift(header, registered.fieldNames())
+    if drift:
+        return drift
+    corrupt = "_corrupt_record"
+    with _csv_lines(lines) as sample:
+        checked = (
+            spark.read
+            .schema(T.StructType(registered.fields + [T.StructField(corrupt, T.StringType(), True)]))
+            .option("header", "true")
+            .option("columnNameOfCorruptRecord", corrupt)
+            .csv(sample)
+        )
+        malformed = sum(1 for row in checked.collect() if row[corrupt] is not None)
+    return {"malformedSampleRows": malformed} if malformed else None
+
+
+def _check_drift(table_name: str, drift: Optional[dict]) -> None:
+    if drift and SCHEMA_DRIFT_POLICY == "reject":
+        raise SchemaDriftError(table_name, drift)
+
+
+def _check_append_drift(table_name: str, drift: Optional[dict], existing: Optional[DataFrame]) -> None:
+    if drift and existing is not None:
+        raise SchemaDriftError(table_name, drift)
+    _check_drift(table_name, drift)
+
+
+def _apply_schema(df: DataFrame, schema: T.StructType) -> DataFrame:
+    return df.select([
+        F.col("`" + f.name.replace("`", "``") + "`").cast(f.dataType).alias(f.name) for f in schema.fields
+    ])
+
+
+_MIN_MAX_TYPES = (T.NumericType, T.StringType, T.DateType, T.TimestampType, T.BooleanType)
+
+
+def _stat_value(value):
+    return value if value is None or isinstance(value, (bool, int, float, str)) else _json_default(value)
+
+
+def _collect_table_stats(df: DataFrame) -> dict:
+    """Row count, estimated size and per-column statistics from one aggregation pass.
+
+    The size is estimated per row the way Spark's cost model does it: an 8
+    byte row header plus each column's default size, or average length plus
+    12 bytes for strings and binaries.
+    """
+    fields = df.schema.fields
+    aggregates = [F.count(F.lit(1)).alias("rows")]
+    for i, field in enumerate(fields):
+        column = F.col("`" + field.name.replace("`", "``") + "`")
+        aggregates += [F.count(column).alias(f"n{i}"), F.approx_count_distinct(column).alias(f"d{i}")]
+        if isinstance(field.dataType, _MIN_MAX_TYPES):
+            aggregates += [F.min(column).alias(f"lo{i}"), F.max(column).alias(f"hi{i}")]
+        if isinstance(field.dataType, (T.StringType, T.BinaryType)):
+            aggregates.append(F.avg(F.length(column)).alias(f"len{i}"))
+    row = df.agg(*aggregates).collect()[0].asDict()
+    rows = row["rows"]
+    row_width = 8
+    columns = {}
+    for i, field in enumerate(fields):
+        avg_length = row.get(f"len{i}")
+        if isinstance(field.dataType, (T.StringType, T.BinaryType)):
+            row_width += int(avg_length or 0) + 12
+        else:
+            row_width += field.dataType.defaultSize()
+        columns[field.name] = {
+            "nullCount": rows - row[f"n{i}"],
+            "distinctCount": row[f"d{i}"],
+            "min": _stat_value(row.get(f"lo{i}")),
+            "max": _stat_value(row.get(f"hi{i}")),
+            "avgLength": avg_length,
+        }
+    return {"rowCount": rows, "sizeInBytes": rows * row_width, "columns": columns, "collectedAt": time.time()}
+
+
+def _merge_table_stats(previous: dict, delta: dict) -> dict:
+    """Statistics of a table after appending rows whose statistics are ``delta``.
+
+    Counts and sizes add up and min/max combine. Distinct counts cannot be
+    merged without the sketches, so their sum is kept as an upper bound.
+    """
+    rows = previous["rowCount"] + delta["rowCount"]
+    columns = {}
+    for name, new in delta["columns"].items():
+        old = previous["columns"].get(name)
+        if old is None:
+            columns[name] = new
+            continue
+        lows = [v for v in (old["min"], new["min"]) if v is not None]
+        highs = [v for v in (old["max"], new["max"]) if v is not None]
+        lengths = [
+            (stats["avgLength"], count - stats["nullCount"])
+            for stats, count in ((old, previous["rowCount"]), (new, delta["rowCount"]))
+            if stats["avgLength"] is not None
+        ]
+        non_null = sum(n for _, n in lengths)
+        columns[name] = {
+            "nullCount": old["nullCount"] + new["nullCount"],
+            "distinctCount": min(old["distinctCount"] + new["distinctCount"], rows),
+            "min": min(lows) if lows else None,
+            "max": max(highs) if highs else None,
+            "avgLength": sum(a * n for a, n in lengths) / non_null if non_null else None,
+        }
+    return {
+        "rowCount": rows,
+        "sizeInBytes": previous["sizeInBytes"] + delta["sizeInBytes"],
+        "columns": columns,
+        "collectedAt": time.time(),
+    }
+
+
+def _broadcastable(stats: Optional[dict]) -> bool:
+    return bool(TABLE_STATS_BROADCAST_BYTES and stats and stats["sizeInBytes"] <= TABLE_STATS_BROADCAST_BYTES)
+
+
+def _apply_table_stats(table_name: str, df: DataFrame, cached: bool) -> Tuple[DataFrame, dict]:
+    """Collect statistics for ``df`` and hand them to the optimizer.
+
+    Cached tables are ANALYZEd so the cost-based optimizer sees row counts and
+    column statistics. Small uncached tables get a broadcast hint, to be
+    registered with the returned DataFrame.
+    """
+    stats = _collect_table_stats(df)
+    stats["broadcast"] = False
+    if cached:
+        try:
+            spark.sql(f"ANALYZE TABLE `{table_name}` COMPUTE STATISTICS FOR ALL COLUMNS")
+        except Exception as e:
+            # Complex column types cannot be analyzed; the table-level size still is
+            logger.debug("Could not analyze %s: %s", table_name, e)
+    elif _broadcastable(stats):
+        df = df.hint("broadcast")
+        stats["broadcast"] = True
+    _table_stats[table_name] = stats
+    return df, stats
+
+
+# Bucketing lives in catalog metadata, so bucketed durable tables are also
+# registered as external tables in this database (their temp view reads them)
+_LAYOUT_DATABASE = "ingest_layout"
+
+
+def _layout_table(table_name: str) -> str:
+    return f"{_LAYOUT_DATABASE}.`{table_name}`"
+
+
+def _parse_layout(
+    partition_by: Optional[str], bucket_by: Optional[str], buckets: Optional[int], sort_by: Optional[str]
+) -> Optional[dict]:
+    """Storage layout from comma-separated form fields, or None for a plain Parquet copy."""
+    def columns(value: Optional[str]) -> List[str]:
+        return [c.strip() for c in (value or "").split(",") if c.strip()]
+
+    layout = {"partitionBy": columns(partition_by), "bucketBy": columns(bucket_by), "buckets": buckets}
+    layout["sortBy"] = columns(sort_by) or layout["bucketBy"]
+    if layout["bucketBy"] and not buckets:
+        raise ValueError("bucketBy needs buckets")
+    if buckets is not None and (buckets < 1 or not layout["bucketBy"]):
+        raise ValueError("buckets must be a positive number and needs bucketBy")
+    if columns(sort_by) and not layout["bucketBy"]:
+        raise ValueError("sortBy needs bucketBy")
+    if set(layout["partitionBy"]) & set(layout["bucketBy"]):
+        raise ValueError("A column cannot be both a partition and a bucket column")
+    return layout if layout["partitionBy"] or layout["bucketBy"] else None
+
+
+def _layout_writer(df: DataFrame, layout: Optional[dict], mode: str):
+    layout_columns = layout["partitionBy"] + layout["bucketBy"] + layout["sortBy"] if layout else []
+    missing = [c for c in layout_columns if c not in df.columns]
+    if missing:
+        raise ValueError(f"Unknown layout columns: {', '.join(missing)}")
+    writer = df.write.mode(mode).option("compression", PARQUET_COMPRESSION)
+    if layout and layout["partitionBy"]:
+        writer = writer.partitionBy(*layout["partitionBy"])
+    if layout and layout["bucketBy"]:
+        writer = writer.bucketBy(layout["buckets"], *layout["bucketBy"]).sortBy(*layout["sortBy"])
+    return writer
+
+
+def _quoted_columns(schema: T.StructType) -> List:
+    return [F.col("`" + f.name.replace("`", "``") + "`") for f in schema.fields]
+
+
+def _read_durable(table_name: str, path: str, schema: T.StructType, layout: Optional[dict]) -> DataFrame:
+    """Read a durable table back in its original column order (partition columns are stored last)."""
+    if layout and layout["bucketBy"]:
+        spark.catalog.refreshTable(_layout_table(table_name))
+        df = spark.table(_layout_table(table_name))
+    else:
+        df = spark.read.schema(schema).parquet(path)
+    return df.select(*_quoted_columns(schema))
+
+
+def _create_layout_table(table_name: str, path: str, schema: T.StructType, layout: dict) -> None:
+    """Re-create the catalog entry of a bucketed table over its existing files."""
+    def names(columns: List[str]) -> str:
+        return ", ".join("`" + c.replace("`", "``") + "`" for c in columns)
+
+    # Partition columns go last, matching the layout the files were written with
+    data_fields = [f for f in schema.fields if f.name not in layout["partitionBy"]]
+    partition_fields = [schema[c] for c in layout["partitionBy"]]
+    columns = ", ".join(f"`{f.name.replace('`', '``')}` {f.dataType.simpleString()}" for f in data_fields + partition_fields)
+    partitioned = f"PARTITIONED BY ({names(layout['partitionBy'])})" if layout["partitionBy"] else ""
+    spark.sql(f"CREATE DATABASE IF NOT EXISTS {_LAYOUT_DATABASE}")
+    spark.sql(f"DROP TABLE IF EXISTS {_layout_table(table_name)}")
+    spark.sql(
+        f"CREATE TABLE {_layout_table(table_name)} ({columns}) USING parquet {partitioned} "
+        f"CLUSTERED BY ({names(layout['bucketBy'])}) SORTED BY ({names(layout['sortBy'])}) "
+        f"INTO {layout['buckets']} BUCKETS LOCATION '{path}'"
+    )
+    if layout["partitionBy"]:
+        spark.sql(f"MSCK REPAIR TABLE {_layout_table(table_name)}")
+
+
+def _drop_layout_table(table_name: str) -> None:
+    if spark.catalog.databaseExists(_LAYOUT_DATABASE):
+        spark.sql(f"DROP TABLE IF EXISTS {_layout_table(table_name)}")
+
+
+def _write_durable(table_name: str, df: DataFrame, layout: Optional[dict] = None) -> Tuple[DataFrame, str]:
+    """Write ``df`` as compressed Parquet in ``layout`` and return a DataFrame reading it back."""
+    path = _storage_uri(table_name, uuid.uuid4().hex, root=TABLE_STORE_DIR)
+    writer = _layout_writer(df, layout, "overwrite")
+    if layout and layout["bucketBy"]:
+        spark.sql(f"CREATE DATABASE IF NOT EXISTS {_LAYOUT_DATABASE}")
+        writer.option("path", path).saveAsTable(_layout_table(table_name))
+    else:
+        writer.parquet(path)
+    return _read_durable(table_name, path, df.schema, layout), path
+
+
+def _restore_durable_tables() -> None:
+    """Re-register durable tables from the manifest without scanning their data.
+
+    Passing the stored schema to the reader skips Parquet footer inference, so
+    only the file listing is touched until the first query. A Spark Connect
+    session may already hold them, registered (and since appended to or
+    cached) by another worker, and those are left alone.
+    """
+    registered = {t.name for t in spark.catalog.listTables()} if SPARK_CONNECT_URL else set()
+    if SPARK_CONNECT_URL:
+        # A restarted Spark Connect server comes back with an empty session
+        for state in (_persisted_tables, _table_row_counts, _table_row_estimates, _table_stats):
+            for name in [n for n in state if n not in registered]:
+                state.pop(name, None)
+    for table_name, entry in table_manifest.load().items():
+        if table_name in registered:
+            continue
+        try:
+            schema = T.StructType.fromJson(json.loads(entry["schema"]))
+            layout = entry.get("layout")
+            if layout and layout["bucketBy"]:
+                _create_layout_table(table_name, entry["path"], schema, layout)
+            df = _read_durable(table_name, entry["path"], schema, layout)
+            stats = entry.get("stats")
+            if stats:
+                _table_stats[table_name] = stats
+                if stats.get("broadcast"):
+                    df = df.hint("broadcast")
+            df.createOrReplaceTempView(table_name)
+            result_cache.invalidate(table_name)
+            _table_row_counts[table_name] = entry.get("rowCount")
+        except Exception as e:
+            logger.warning("Could not restore durable table %s: %s", table_name, e)
+    _restore_materialized_views(registered)
+    catalog_index.invalidate()
+
+
+def _register_table(
+    table_name: str,
+    df: DataFrame,
+    row_count: Optional[int],
+    persist_level: str,
+    durable: bool,
+    count_rows: bool = True,
+    timer: Optional[PhaseTimer] = None,
+    layout: Optional[dict] = None,
+) -> Tuple[DataFrame, Optional[int], Optional[str]]:
+    """Register ``df`` as ``table_name`` with optional persistence and Parquet copy.
+
+    A storage ``layout`` (partitioning and bucketing) implies a durable copy.
+    Returns the registered DataFrame, its row count (None if unknown) and the
+    durable Parquet path (None if not durable).
+    """
+    timer = timer or PhaseTimer()
+    if _persisted_tables.pop(table_name, None):
+        # Free the previous version's cached blocks before the view is replaced
+        spark.catalog.uncacheTable(table_name)
+
+    _table_stats.pop(table_name, None)
+
+    durable = durable or layout is not None
+    durable_path = None
+    if durable:
+        with timer.phase("durable"):
+            df, durable_path = _write_durable(table_name, df, layout)
+
+    # Bulk ingests that skip counting also skip statistics unless the data is
+    # cached or was just written as Parquet
+    stats = None
+    collect_stats = TABLE_STATS_ENABLED and (count_rows or durable or persist_level != "NONE")
+    if collect_stats and persist_level == "NONE":
+        with timer.phase("stats"):
+            df, stats = _apply_table_stats(table_name, df, cached=False)
+            row_count = stats["rowCount"]
+
+    # Register as temp view
+    with timer.phase("register"):
+        df.createOrReplaceTempView(table_name)
+        result_cache.invalidate(table_name)
+        _refresh_dependent_views(table_name)
+
+    if persist_level != "NONE":
+        with timer.phase("persist"):
+            spark.catalog.cacheTable(table_name, _storage_level(persist_level))
+            _persisted_tables[table_name] = persist_level
+            df = spark.table(table_name)
+            # Materialize the cache; the count comes from the same pass
+            row_count = df.count()
+        if collect_stats:
+            with timer.phase("stats"):
+                # Read from the cache that was just built
+                _, stats = _apply_table_stats(table_name, df, cached=True)
+    elif row_count is None and count_rows:
+        with timer.phase("count"):
+            row_count = df.count()
+    _table_row_counts[table_name] = row_count
+    _table_row_estimates.pop(table_name, None)
+    timer.df = df
+    catalog_index.put_table(table_name, df.dtypes)
+
+    if durable_path:
+        table_manifest.put(
+            table_name,
+            {
+                "path": durable_path,
+                "schema": df.schema.json(),
+                "rowCount": row_count,
+                "stats": stats,
+                "layout": layout,
+                "updatedAt": time.time(),
+            },
+        )
+        if not (layout and layout["bucketBy"]):
+            _drop_layout_table(table_name)
+        _remove_siblings(_storage_uri(table_name, root=TABLE_STORE_DIR), durable_path.rsplit("/", 1)[-1])
+    elif table_manifest.remove(table_name):
+        # A non-durable re-registration replaces the durable copy
+        _drop_layout_table(table_name)
+        _remove_siblings(_storage_uri(table_name, root=TABLE_STORE_DIR), "")
+    return df, row_count, durable_path
+
+
+def _appendable_table(table_name: str) -> Optional[DataFrame]:
+    """The current version of a table that an upload is appended to, if it exists."""
+    if table_name in _views:
+        raise ValueError(f"Cannot append to materialized view '{table_name}'")
+    return spark.table(table_name) if spark.catalog.tableExists(table_name) else None
+
+
+def _append_table(
+    table_name: str,
+    existing: DataFrame,
+    delta: DataFrame,
+    delta_rows: Optional[int],
+    persist_level: str,
+    timer: Optional[PhaseTimer] = None,
+) -> Tuple[DataFrame, Optional[int], Optional[str], int]:
+    """Add the rows of ``delta`` to an existing table without re-ingesting it.
+
+    Durable tables get the delta written as new Parquet files next to the
+    existing ones; other tables become a union of the old view and the delta.
+    Returns the registered DataFrame, the new row count (None if unknown), the
+    durable path and the number of appended rows.
+    """
+    timer = timer or PhaseTimer()
+    entry = table_manifest.load().get(table_name)
+    durable_path = entry["path"] if entry else None
+    # Existing statistics are merged with those of the new rows, so only the
+    # delta is scanned; without them the whole table gets one pass below
+    previous_stats = _table_stats.get(table_name) if TABLE_STATS_ENABLED else None
+    delta_stats = None
+    if previous_stats is not None:
+        with timer.phase("stats"):
+            delta_stats = _collect_table_stats(delta)
+        delta_rows = delta_stats["rowCount"]
+    if delta_rows is None:
+        with timer.phase("count"):
+            delta_rows = delta.count()
+
+    if durable_path:
+        layout = entry.get("layout")
+        with timer.phase("durable"):
+            # Appends keep the table's partitioning and bucketing
+            writer = _layout_writer(delta, layout, "append")
+            if layout and layout["bucketBy"]:
+                writer.saveAsTable(_layout_table(table_name))
+            else:
+                writer.parquet(durable_path)
+            df = _read_durable(table_name, durable_path, existing.schema, layout)
+    else:
+        df = existing.unionByName(delta)
+
+    stats = None
+    level = _persisted_tables.get(table_name) or persist_level
+    if delta_stats is not None:
+        stats = _merge_table_stats(previous_stats, delta_stats)
+        # A re-cached table gets its size and row count from the cache; the
+        # column statistics of the previous ANALYZE are not carried over
+        stats["broadcast"] = level == "NONE" and _broadcastable(stats)
+        if stats["broadcast"]:
+            df = df.hint("broadcast")
+        _table_stats[table_name] = stats
+    elif TABLE_STATS_ENABLED and level == "NONE":
+        with timer.phase("stats"):
+            df, stats = _apply_table_stats(table_name, df, cached=False)
+    if _persisted_tables.pop(table_name, None):
+        # Replacing the view drops its cache anyway; uncache by name as _register_table does
+        spark.catalog.uncacheTable(table_name)
+
+    with timer.phase("register"):
+        df.createOrReplaceTempView(table_name)
+        result_cache.invalidate(table_name)
+    if level != "NONE":
+        with timer.phase("persist"):
+            # Cached by name, so /tables finds the "In-memory table" blocks
+            spark.catalog.cacheTable(table_name, _storage_level(level))
+            _persisted_tables[table_name] = level
+            df = spark.table(table_name)
+            df.count()
+    if TABLE_STATS_ENABLED and level != "NONE" and stats is None:
+        with timer.phase("stats"):
+            _, stats = _apply_table_stats(table_name, df, cached=True)
+
+    previous = _table_row_counts.get(table_name)
+    row_count = previous + delta_rows if previous is not None else None
+    if table_name in _table_row_estimates:
+        _table_row_estimates[table_name] += delta_rows
+    if stats:
+        row_count = stats["rowCount"]
+    _table_row_counts[table_name] = row_count
+    timer.df = df
+    if durable_path:
+        table_manifest.put(table_name, {**entry, "rowCount": row_count, "stats": stats, "updatedAt": time.time()})
+    with timer.phase("views"):
+        _on_table_appended(table_name, delta)
+    return df, row_count, durable_path, delta_rows
+
+
+def _preview(df: DataFrame) -> List[dict]:
+    preview_limit = min(5, RESULT_ROW_LIMIT)
+    return [row.asDict(recursive=True) for row in df.limit(preview_limit).collect()]
+
+
+def _ingest_upload(
+    table_name: str,
+    ingest_mode: str,
+    source,
+    persist_level: str,
+    durable: bool,
+    timer: Optional[PhaseTimer] = None,
+    append: bool = False,
+    layout: Optional[dict] = None,
+) -> dict:
+    timer = timer or PhaseTimer()
+    existing = _appendable_table(table_name) if append else None
+    # Appended rows must match the table they extend, whatever the drift policy
+    registered = existing.schema if existing is not None else _registered_schema(table_name)
+    drift = None
+    if ingest_mode == "stream":
+        if registered is not None:
+            with timer.phase("schema"):
+                drift = _csv_drift(_csv_sample(source), registered)
+            _check_append_drift(table_name, drift, existing)
+        reader = spark.read.option("header", "true")
+        with timer.phase("parse"):
+            if registered is not None and drift is None:
+                # Reuse the registered schema and skip the inference pass over the file
+                df = reader.schema(registered).csv(source)
+            else:
+                # Executors parse the file from shared storage in parallel
+                df = reader.option("inferSchema", "true").csv(source)
+        conversion = None
+        row_count = None
+    else:
+        # Parse with pandas to infer schema (numeric types, etc.)
+        with timer.phase("decode"):
+            text_stream = io.StringIO(source.decode("utf-8", errors="ignore"))
+        with timer.phase("parse"):
+            pdf = pd.read_csv(text_stream)
+        row_count = len(pdf)
+        if registered is not None:
+            with timer.phase("schema"):
+                drift = _pandas_drift(pdf, registered)
+            _check_append_drift(table_name, drift, existing)
+
+        # Create Spark DataFrame
+        with timer.phase("convert"):
+            df, conversion = _pandas_to_spark(pdf)
+            if registered is not None and drift is None:
+                df = _apply_schema(df, registered)
+
+    if existing is not None:
+        schema_source = "table"
+        df, row_count, durable_path, appended_rows = _append_table(
+            table_name, existing, df, row_count, persist_level, timer=timer
+        )
+    else:
+        schema_source = "registry" if registered is not None and drift is None else "inferred"
+        if schema_source == "inferred":
+            _register_schema(table_name, df.schema)
+
+        df, row_count, durable_path = _register_table(
+            table_name, df, row_count, persist_level, durable, timer=timer, layout=layout
+        )
+        appended_rows = None
+        if ingest_mode == "stream":
+            # Appended files stay in place because earlier versions of the view still read them
+            _remove_stale_uploads(table_name, source)
+
+    with timer.phase("preview"):
+        preview = _preview(df)
+
+    if appended_rows is not None:
+        message = f"Appended {appended_rows} rows to '{table_name}'"
+    else:
+        message = f"Registered '{table_name}' as a temporary view with {row_count} rows"
+    return {
+        "message": message,
+        "tableName": table_name,
+        "columns": df.columns,
+        "preview": preview,
+        "rowCount": row_count,
+        "ingestMode": ingest_mode,
+        "conversion": conversion,
+        "persisted": persist_level if persist_level != "NONE" else None,
+        "durablePath": durable_path,
+        "schemaSource": schema_source,
+        "schemaDrift": drift,
+        "appendedRows": appended_rows,
+        # Appends keep the layout the table was created with
+        "layout": layout if existing is None else None,
+    }
+
+
+def _resolve_data_path(path: str) -> str:
+    """Map a directory or glob on the shared mount (or HDFS) to a Spark URI.
+
+    Relative paths are taken from DATA_DIR; local paths outside it are rejected.
+    """
+    if path.startswith("hdfs://"):
+        if not HDFS_URL or not path.startswith(HDFS_URL.rstrip("/") + "/"):
+            raise ValueError("HDFS paths must be on HDFS_URL")
+        return path
+    if path.startswith("file://"):
+        path = path[len("file://"):]
+    root = os.path.normpath(DATA_DIR)
+    local = os.path.normpath(os.path.join(root, path))
+    if local != root and not local.startswith(root + os.sep):
+        raise ValueError(f"Path must be inside {DATA_DIR}")
+    return "file://" + local
+
+
+def _infer_csv_schema(lines: List[str]) -> T.StructType:
+    """Infer a CSV schema from sampled lines instead of a full scan."""
+    # Repeated header lines from other files in the sample are dropped by the reader
+    with _csv_lines(lines) as sample:
+        return spark.read.option("header", "true").option("inferSchema", "true").csv(sample).schema
+
+
+def _file_bytes(uris: List[str]) -> Optional[int]:
+    """Total size of local or HDFS files, or None if one cannot be read."""
+    total = 0
+    try:
+        for uri in uris:
+            if uri.startswith("file:"):
+                total += os.path.getsize(urllib.parse.unquote(urllib.parse.urlparse(uri).path))
+            elif SPARK_CONNECT_URL:
+                return None  # sizes of remote files are only visible through the driver JVM
+            else:
+                total += _hadoop_fs(uri).getFileStatus(spark._jvm.org.apache.hadoop.fs.Path(uri)).getLen()
+    except Exception as e:
+        logger.debug("Could not size input files: %s", e)
+        return None
+    return total
+
+
+def _estimate_csv_rows(lines: List[str], files: List[str]) -> Optional[int]:
+    """Rows in CSV ``files`` estimated from their size and the sampled line length."""
+    body = lines[1:]
+    size = _file_bytes(files) if body else None
+    if size is None:
+        return None
+    bytes_per_row = sum(len(line.encode("utf-8")) + 1 for line in body) / len(body)
+    return int(size / bytes_per_row)
+
+
+def _ingest_path(
+    table_name: str,
+    uri: str,
+    partition_column: Optional[str],
+    partition_pattern: str,
+    persist_level: str,
+    durable: bool,
+    layout: Optional[dict] = None,
+) -> dict:
+    registered = _registered_schema(table_name)
+    lines = _csv_sample(uri)
+    drift = _csv_drift(lines, registered) if registered is not None else None
+    _check_drift(table_name, drift)
+    if registered is not None and drift is None:
+        schema, schema_source = registered, "registry"
+    else:
+        schema, schema_source = _infer_csv_schema(lines), "inferred"
+        _register_schema(table_name, schema)
+
+    df = spark.read.option("header", "true").schema(schema).csv(uri)
+    if partition_column:
+        df = df.withColumn(partition_column, F.regexp_extract(F.input_file_name(), partition_pattern, 1))
+    input_files = df.inputFiles()
+    files = len(input_files)
+    df, row_count, durable_path = _register_table(
+        table_name, df, None, persist_level, durable, count_rows=False, layout=layout
+    )
+    if row_count is None:
+        # Sizes samples for approximate queries without a full count
+        estimate = _estimate_csv_rows(lines, input_files)
+        if estimate:
+            _table_row_estimates[table_name] = estimate
+    return {
+        "message": f"Registered '{table_name}' from {files} files",
+        "tableName": table_name,
+        "columns": df.columns,
+        "preview": _preview(df),
+        "rowCount": row_count,
+        "files": files,
+        "persisted": persist_level if persist_level != "NONE" else None,
+        "durablePath": durable_path,
+        "schemaSource": schema_source,
+        "schemaDrift": drift,
+        "layout": layout,
+    }
+
+
+RESULT_FORMATS = ("rows", "columnar")
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value)
+
+
+class RawJson(str):
+    """Already serialized JSON, spliced into response bodies without encoding it again."""
+
+
+def _dump_json(result: dict) -> str:
+    """Compact JSON for ``result``; RawJson values are inserted as they are."""
+    raw = {key: value for key, value in result.items() if isinstance(value, RawJson)}
+    body = json.dumps(
+        {key: value for key, value in result.items() if key not in raw},
+        default=_json_default,
+        separators=(",", ":"),
+    )
+    if not raw:
+        return body
+    spliced = ",".join(f"{json.dumps(key)}:{value}" for key, value in raw.items())
+    return body[:-1] + ("," if len(body) > 2 else "") + spliced + "}"
+
+
+def _serialize_result(rows: list, columns: List[str], fmt: str, max_bytes: int) -> Tuple[dict, int]:
+    """Lay out collected rows as ``fmt`` within ``max_bytes``; returns the layout and rows kept.
+
+    Every record is encoded once: its length counts against the budget and
+    the text becomes part of the ``data`` RawJson. Columnar results keep
+    nested structs as arrays (field names are in the schema) instead of
+    converting every Row to a dict.
+    """
+    def encode(value) -> str:
+        return json.dumps(value, default=_json_default, separators=(",", ":"))
+
+    if fmt == "rows":
+        records = [encode(row.asDict(recursive=True)) for row in rows]
+        sizes = [len(record) + 1 for record in records]
+    else:
+        records = [[encode(value) for value in row] for row in rows]
+        sizes = [sum(len(cell) + 1 for cell in record) for record in records]
+    kept = len(records)
+    if max_bytes > 0:
+        used = 0
+        for i, size in enumerate(sizes):
+            used += size
+            if used > max_bytes and i > 0:
+                kept = i
+                break
+        records = records[:kept]
+    if fmt == "rows":
+        return {"data": RawJson("[" + ",".join(records) + "]")}, kept
+    data = ",".join("[" + ",".join(record[i] for record in records) + "]" for i in range(len(columns)))
+    return {"data": RawJson("[" + data + "]")}, kept
+
+
+def _execute_query(
+    query: str,
+    route: str = "/query",
+    timer: Optional[PhaseTimer] = None,
+    fmt: str = "rows",
+    offset: int = 0,
+    approx: bool = False,
+) -> dict:
+    timer = timer or PhaseTimer()
+    with timer.phase("cache"):
+        # Approximate results differ run to run, so they are never cached
+        cache_key = None if approx else result_cache.key_for(query, _catalog_views)
+        if cache_key is not None:
+            cache_key = cache_key + (fmt, offset)
+        cached = result_cache.get(cache_key) if cache_key is not None else None
+    if cached is not None:
+        return {**cached, "cached": True}
+
+    with timer.phase("analyze"):
+        df = spark.sql(query)
+        columns = df.columns
+        plan = _approximate_plan(query, columns) if approx else None
+        if plan is not None and plan["mode"] != "exact":
+            df = plan["df"]
+    timer.df = df
+    if cache_key is None and not normalize_sql(query).startswith(("select", "with")):
+        # DDL/DML through /query (e.g. CREATE OR REPLACE VIEW) may change any table
+        result_cache.clear()
+        catalog_index.invalidate()
+    # One extra row tells whether the row limit cut the result
+    limited = (df.offset(offset) if offset else df).limit(RESULT_ROW_LIMIT + 1)
+    try:
+        with timer.phase("collect"):
+            rows = limited.collect()
+    finally:
+        if plan is not None and plan["view"]:
+            spark.catalog.dropTempView(plan["view"])
+    bounds = None
+    if plan is not None:
+        rows, bounds = _approximate_rows(plan, rows)
+    with timer.phase("serialize"):
+        layout, kept = _serialize_result(rows[:RESULT_ROW_LIMIT], columns, fmt, RESULT_MAX_BYTES)
+    RESULT_ROWS.labels(route).observe(kept)
+    truncated_by = None
+    if kept < min(len(rows), RESULT_ROW_LIMIT):
+        truncated_by = "bytes"
+    elif len(rows) > RESULT_ROW_LIMIT:
+        truncated_by = "rows"
+    result = {
+        "columns": columns,
+        **layout,
+        "limit": RESULT_ROW_LIMIT,
+        "format": fmt,
+        "offset": offset,
+        "truncatedBy": truncated_by,
+        # Re-run with this offset to fetch the next slice; stable only with ORDER BY
+        "nextOffset": offset + kept if truncated_by else None,
+    }
+    if fmt == "columnar":
+        fields = df.schema.fields[:len(columns)]
+        result["schema"] = [{"name": f.name, "type": f.dataType.simpleString()} for f in fields]
+    if plan is not None:
+        result["approximate"] = _describe_approximation(plan, bounds, kept)
+    if cache_key is not None:
+        result_cache.put(cache_key, result, size=len(_dump_json(result)))
+    return {**result, "cached": False}
+
+
+def _cached_table_sizes() -> Dict[str, int]:
+    """Bytes held in executor memory and disk per cached table."""
+    sizes = {}
+    if SPARK_CONNECT_URL:
+        return sizes  # block storage is only visible through the driver JVM
+    prefix = "In-memory table "
+    for info in spark.sparkContext._jsc.sc().getRDDStorageInfo():
+        name = info.name()
+        if name.startswith(prefix):
+            sizes[name[len(prefix):]] = info.memSize() + info.diskSize()
+    return sizes
+
+
+def _list_tables() -> dict:
+    cached_sizes = _cached_table_sizes()
+    results = []
+    for t in spark.catalog.listTables():
+        results.append(
+            {
+                "name": t.name,
+                "database": t.database,
+                "tableType": t.tableType,
+                "isTemporary": t.isTemporary,
+                "rowCount": _table_row_counts.get(t.name),
+                "storageLevel": _persisted_tables.get(t.name),
+                "cachedBytes": cached_sizes.get(t.name),
+            }
+        )
+    return {"tables": results}
+
+
+def _drop_table(table: str) -> dict:
+    if _persisted_tables.pop(table, None):
+        spark.catalog.uncacheTable(table)
+    dropped = spark.catalog.dropTempView(table)
+    durable = table_manifest.remove(table) is not None
+    if durable:
+        _drop_layout_table(table)
+        _remove_siblings(_storage_uri(table, root=TABLE_STORE_DIR), "")
+    if not dropped and not durable:
+        raise ValueError(f"Table '{table}' not found")
+    _table_row_counts.pop(table, None)
+    _table_row_estimates.pop(table, None)
+    _table_stats.pop(table, None)
+    result_cache.forget(table)
+    catalog_index.invalidate()
+    return {"table": table, "dropped": True}
+
+
+def _unpersist_table(table: str) -> dict:
+    spark.catalog.uncacheTable(table)
+    _persisted_tables.pop(table, None)
+    return {"table": table, "persisted": False}
+
+
+def _describe_table(table: str) -> dict:
+    df = spark.table(table)
+    stats = _table_stats.get(table)
+    column_stats = stats["columns"] if stats else {}
+    cols = [{"name": name, "type": dtype, "stats": column_stats.get(name)} for name, dtype in df.dtypes]
+    table_stats = {k: v for k, v in stats.items() if k != "columns"} if stats else None
+    return {"table": table, "columns": cols, "stats": table_stats}
+
 
-spark = (
-    SparkSession.builder
-    .appName("CSVUploader")
-    .master(SPARK_MASTER_URL)
-    .getOrCreate()
-)
+def _accepted_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip())
+    for encoding in ("zstd", "gzip"):
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def _encode_result(result: dict, accept_encoding: str, status_code: int = 200) -> Response:
+    """Serialize a result and compress it with the best encoding the client accepts."""
+    body = _dump_json(result).encode("utf-8")
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = _accepted_encoding(accept_encoding) if len(body) >= RESULT_COMPRESSION_MIN_BYTES else None
+    if encoding == "zstd":
+        body = zstandard.ZstdCompressor(level=3).compress(body)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=6)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, status_code=status_code, headers=headers, media_type="application/json")
+
+
+def _result_format(fmt: Optional[str]) -> str:
+    fmt = (fmt or RESULT_FORMAT).lower()
+    if fmt not in RESULT_FORMATS:
+        raise ValueError(f"Unknown result format '{fmt}', expected one of {', '.join(RESULT_FORMATS)}")
+    return fmt
+
+
+def _cancelled_response(e: SparkJobCancelled) -> JSONResponse:
+    headers = {"Retry-After": "1"} if isinstance(e, (AdmissionRejected, SparkNotReady)) else None
+    return JSONResponse(status_code=e.status_code, content={"detail": str(e)}, headers=headers)
+
+
+def _drift_response(e: SchemaDriftError) -> JSONResponse:
+    return JSONResponse(status_code=409, content={"detail": str(e), "schemaDrift": e.drift})
 
-# Permissive CORS for demo; tighten in production
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(
+    request: Request,
+    response: Response,
+    file: UploadFile = File(...),
+    mode: Optional[str] = Form(None),
+    persist: Optional[str] = Form(None),
+    durable: Optional[bool] = Form(None),
+    table: Optional[str] = Form(None),
+    append: bool = Form(False),
+    partition_by: Optional[str] = Form(None, alias="partitionBy"),
+    bucket_by: Optional[str] = Form(None, alias="bucketBy"),
+    buckets: Optional[int] = Form(None),
+    sort_by: Optional[str] = Form(None, alias="sortBy"),
+):
     try:
-        # Read uploaded CSV into memory
-        content = await file.read()
-        if not content:
-            return JSONResponse(status_code=400, content={"detail": "Empty file"})
-
-        # Parse with pandas to infer schema (numeric types, etc.)
-        text_stream = io.StringIO(content.decode("utf-8", errors="ignore"))
-        pdf = pd.read_csv(text_stream)
+        ingest_mode = (mode or UPLOAD_INGEST_MODE).lower()
+        if ingest_mode not in ("memory", "stream"):
+            return JSONResponse(status_code=400, content={"detail": f"Unknown ingest mode '{ingest_mode}'"})
+        persist_level = (persist or UPLOAD_PERSIST_LEVEL).upper()
+        if persist_level != "NONE" and _storage_level(persist_level) is None:
+            return JSONResponse(status_code=400, content={"detail": f"Unknown storage level '{persist_level}'"})
 
-        # Create Spark DataFrame and register as temp view
-        table_name = os.path.splitext(os.path.basename(file.filename))[0]
-        # Sanitize table name: letters, numbers, underscore only
-        table_name = "".join(c if c.isalnum() or c == "_" else "_" for c in table_name)
-        if not table_name:
-            table_name = "uploaded_table"
+        try:
+            layout = _parse_layout(partition_by, bucket_by, buckets, sort_by)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"detail": str(e)})
 
-        df = spark.createDataFrame(pdf)
-        df.createOrReplaceTempView(table_name)
+        table_name = _sanitize_table_name(table) if table else _table_name_from(file.filename)
+        timer = PhaseTimer()
 
-        # Preview first few rows
-        preview_limit = min(5, RESULT_ROW_LIMIT)
-        preview_rows = [row.asDict(recursive=True) for row in df.limit(preview_limit).collect()]
+        # Before touching the body: streaming to HDFS needs the session, and a
+        # file written while Spark is down would only be left behind
+        _require_spark()
+        with timer.phase("read"):
+            if ingest_mode == "stream":
+                # Copy the spooled upload to shared storage without holding it in memory
+                source = await run_in_threadpool(_stream_to_storage, file.file, table_name)
+            else:
+                # Read uploaded CSV into memory
+                source = await file.read()
+        if not source:
+            return JSONResponse(status_code=400, content={"detail": "Empty file"})
+        UPLOAD_BYTES.labels(ingest_mode).observe(len(source) if ingest_mode == "memory" else file.size or 0)
 
-        return {
-            "message": f"Registered '{table_name}' as a temporary view with {df.count()} rows",
-            "tableName": table_name,
-            "columns": df.columns,
-            "preview": preview_rows,
-        }
+        try:
+            result = await run_spark(
+                request,
+                f"upload {table_name}",
+                _ingest_stored_upload,
+                table_name,
+                ingest_mode,
+                source,
+                persist_level,
+                UPLOAD_DURABLE if durable is None else durable,
+                timer,
+                append,
+                layout,
+            )
+        except (AdmissionRejected, SparkNotReady):
+            # Rejected before the ingest started, so nothing reads the streamed file
+            if ingest_mode == "stream":
+                await run_in_threadpool(_delete_uri, source)
+            raise
+        await _finish_timing(response, timer, "upload", table=table_name)
+        return result
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except SchemaDriftError as e:
+        return _drift_response(e)
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": f"Upload failed: {e}"})
 
 
+@app.post("/ingest")
+async def ingest_path(
+    request: Request,
+    table: str = Form(...),
+    path: str = Form(...),
+    partition_column: Optional[str] = Form(None, alias="partitionColumn"),
+    partition_pattern: str = Form(r"(\d{4}-\d{2}-\d{2})", alias="partitionPattern"),
+    persist: Optional[str] = Form(None),
+    durable: Optional[bool] = Form(None),
+    partition_by: Optional[str] = Form(None, alias="partitionBy"),
+    bucket_by: Optional[str] = Form(None, alias="bucketBy"),
+    buckets: Optional[int] = Form(None),
+    sort_by: Optional[str] = Form(None, alias="sortBy"),
+):
+    try:
+        table_name = _sanitize_table_name(table)
+        persist_level = (persist or UPLOAD_PERSIST_LEVEL).upper()
+        if persist_level != "NONE" and _storage_level(persist_level) is None:
+            return JSONResponse(status_code=400, content={"detail": f"Unknown storage level '{persist_level}'"})
+        try:
+            if partition_column is not None and re.compile(partition_pattern).groups < 1:
+                raise ValueError("partitionPattern needs a capture group")
+            uri = _resolve_data_path(path)
+            layout = _parse_layout(partition_by, bucket_by, buckets, sort_by)
+        except (ValueError, re.error) as e:
+            return JSONResponse(status_code=400, content={"detail": str(e)})
+
+        return await run_spark(
+            request,
+            f"ingest {table_name}",
+            _ingest_path,
+            table_name,
+            uri,
+            partition_column,
+            partition_pattern,
+            persist_level,
+            UPLOAD_DURABLE if durable is None else durable,
+            layout,
+        )
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except SchemaDriftError as e:
+        return _drift_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": f"Ingest failed: {e}"})
+
+
 @app.post("/query")
-async def run_query(query: str = Form(...)):
+async def run_query(
+    request: Request,
+    query: str = Form(...),
+    format: Optional[str] = Form(None),
+    offset: int = Form(0),
+    limit: Optional[int] = Form(None),
+    approx: bool = Form(False),
+):
+    # Approximate results carry error bounds, so they are always returned as JSON
+    if _wants_arrow(request) and not approx:
+        # Streamed in record batches, so neither RESULT_ROW_LIMIT nor RESULT_MAX_BYTES applies
+        group_id = f"arrow-{uuid.uuid4().hex}"
+        return await _stream_response(
+            request, _arrow_batches(query, group_id, limit), group_id, ARROW_STREAM_MEDIA_TYPE
+        )
     try:
-        df = spark.sql(query)
-        limited = df.limit(RESULT_ROW_LIMIT)
-        data = [row.asDict(recursive=True) for row in limited.collect()]
-        return {
-            "columns": df.columns,
-            "data": data,
-            "limit": RESULT_ROW_LIMIT,
-        }
+        timer = PhaseTimer()
+        fmt = _result_format(format)
+        result = await run_spark(
+            request, "query", _execute_query, query, "/query", timer, fmt, max(0, offset), approx
+        )
+        with timer.phase("encode"):
+            response = await run_in_threadpool(_encode_result, result, request.headers.get("accept-encoding", ""))
+        await _finish_timing(response, timer, "query", sql=query)
+        return response
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
     except Exception as e:
         return JSONResponse(status_code=400, content={"detail": f"Query error: {e}"})
 
 
 @app.get("/tables")
-async def list_tables():
-    try:
-        tables = spark.catalog.listTables()
-        results = []
-        for t in tables:
-            results.append(
-                {
-                    "name": t.name,
-                    "database": t.database,
-                    "tableType": t.tableType,
-                    "isTemporary": t.isTemporary,
-                }
-            )
-        return {"tables": results}
+async def list_tables(request: Request):
+    try:
+        return await run_spark(request, "list tables", _list_tables)
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": f"List tables failed: {e}"})
 
 
 @app.get("/columns")
-async def list_columns(table: str):
+async def list_columns(request: Request, table: str):
     try:
         if not table:
             return JSONResponse(status_code=400, content={"detail": "Missing 'table' parameter"})
-        df = spark.table(table)
-        cols = [{"name": name, "type": dtype} for name, dtype in df.dtypes]
-        return {"table": table, "columns": cols}
+        return await run_spark(request, f"describe {table}", _describe_table, table)
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
     except Exception as e:
         return JSONResponse(status_code=404, content={"detail": f"Describe table failed: {e}"})
+
+
+async def _refresh_catalog(request: Request) -> None:
+    """Rebuild a stale catalog snapshot; fresh ones are served without admission."""
+    if catalog_index.stale:
+        await run_spark(request, "catalog snapshot", catalog_index.refresh)
+
+
+@app.get("/schema")
+async def get_schema(request: Request):
+    try:
+        await _refresh_catalog(request)
+        return catalog_index.snapshot()
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": f"Schema snapshot failed: {e}"})
+
+
+@app.get("/complete")
+async def complete(request: Request, prefix: str = "", kind: Optional[str] = None, limit: int = 50):
+    if kind is not None and kind not in ("keyword", "table", "column"):
+        return JSONResponse(status_code=400, content={"detail": f"Unknown suggestion kind '{kind}'"})
+    try:
+        await _refresh_catalog(request)
+        return catalog_index.complete(prefix, kind, max(1, min(limit, 500)))
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": f"Completion failed: {e}"})
+
+
+@app.delete("/tables/{table}")
+async def drop_table(request: Request, table: str):
+    try:
+        return await run_spark(request, f"drop {table}", _drop_table, table)
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=404, content={"detail": f"Drop table failed: {e}"})
+
+
+@app.delete("/tables/{table}/cache")
+async def unpersist_table(request: Request, table: str):
+    try:
+        return await run_spark(request, f"unpersist {table}", _unpersist_table, table)
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=404, content={"detail": f"Unpersist failed: {e}"})
+
+
+@app.get("/schemas")
+async def list_schemas():
+    try:
+        entries = await run_in_threadpool(schema_registry.load)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": f"Schema registry unavailable: {e}"})
+    return {
+        "schemas": [
+            {"table": name, "schema": json.loads(entry["schema"]), "updatedAt": entry.get("updatedAt")}
+            for name, entry in sorted(entries.items())
+        ]
+    }
+
+
+@app.delete("/schemas/{table}")
+async def forget_schema(table: str):
+    try:
+        removed = await run_in_threadpool(schema_registry.remove, table)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": f"Schema registry unavailable: {e}"})
+    if removed is None:
+        return JSONResponse(status_code=404, content={"detail": f"No registered schema for '{table}'"})
+    return {"table": table, "removed": True}
+
+
+@app.get("/ready")
+async def ready():
+    status = spark_startup.status()
+    connected = False
+    if spark_startup.ready:
+        try:
+            connected = await asyncio.wait_for(run_in_threadpool(_spark_alive, spark), timeout=5)
+        except Exception as e:
+            status["error"] = str(e) or type(e).__name__
+    content = {"ready": connected, "spark": {**status, "connected": connected}}
+    return content if connected else JSONResponse(status_code=503, content=content)
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return result_cache.stats()
+
+
+class QueryJob:
+    """A /jobs query running in the background under its own Spark job group."""
+
+    TERMINAL = ("succeeded", "failed", "cancelled")
+
+    def __init__(self, query: str, fmt: str = "rows", offset: int = 0, approx: bool = False):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.fmt = fmt
+        self.offset = offset
+        self.approx = approx
+        self.status = "queued"
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.submitted_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.future = None
+
+    @property
+    def group_id(self) -> str:
+        return f"job-{self.id}"
+
+    def run(self) -> None:
+        self.sync()
+        if self.status == "cancelled":
+            return
+        self.status = "running"
+        self._publish()
+        try:
+            result = _in_job_group(
+                self.group_id, f"query job {self.id}", _execute_query,
+                self.query, "/jobs", None, self.fmt, self.offset, self.approx,
+            )
+            if self.status != "cancelled":
+                self.result, self.status = result, "succeeded"
+        except Exception as e:
+            if self.status != "cancelled":
+                self.error, self.status = str(e), "failed"
+        finally:
+            self.finished_at = time.time()
+            self._publish()
+            _observe_spark_group_later(self.group_id, "/jobs")
+
+    async def admit_and_run(self, client: str, admitted: asyncio.Future) -> None:
+        """Wait for admission, then run under REQUEST_TIMEOUT_SECONDS like /query."""
+        try:
+            await admission.wait(client, admitted)
+        except AdmissionRejected as e:
+            self.error, self.status, self.finished_at = str(e), "failed", time.time()
+            await run_in_threadpool(self._publish)
+            return
+        try:
+            await run_in_threadpool(self.sync)
+            if self.status == "cancelled":
+                return
+            self.future = spark_pool.submit(self.run)
+            done, _ = await asyncio.wait({asyncio.wrap_future(self.future)}, timeout=REQUEST_TIMEOUT_SECONDS)
+            if not done:
+                await run_in_threadpool(self.cancel)
+                self.error = f"Query timed out after {REQUEST_TIMEOUT_SECONDS:g}s"
+                await run_in_threadpool(self._publish)
+        finally:
+            admission.release(client)
+
+    def cancel(self) -> None:
+        if self.status in self.TERMINAL:
+            return
+        self.status = "cancelled"
+        # Jobs still waiting for admission have no future yet
+        if self.future is None or self.future.cancel():
+            self.finished_at = time.time()
+        self._publish()
+        _cancel_group(self.group_id)
+
+    def sync(self) -> None:
+        """Adopt a cancel requested through another worker."""
+        if _job_records is None or self.status in self.TERMINAL:
+            return
+        record = _job_records.get(self.id)
+        if record and record["status"] == "cancelled":
+            self.status, self.finished_at = "cancelled", record["finishedAt"]
+
+    def _publish(self) -> None:
+        """Mirror the job's state, and its result once it succeeds, for other workers."""
+        if _job_records is None:
+            return
+        if self.status == "succeeded":
+            _write_text(_job_result_uri(self.id), _dump_json(self.result))
+
+        def merge(record: Optional[dict]) -> dict:
+            if record and record["status"] == "cancelled" and self.status != "cancelled":
+                # Cancelled through another worker while this one was finishing
+                self.status, self.result, self.error = "cancelled", None, None
+            return self.record()
+
+        _job_records.modify(self.id, merge)
+
+    def progress(self) -> Optional[dict]:
+        if SPARK_CONNECT_URL:
+            return None  # no status tracker without a local SparkContext
+        tracker = spark.sparkContext.statusTracker()
+        stages_total = stages_completed = tasks_total = tasks_completed = tasks_active = tasks_failed = 0
+        for spark_job_id in tracker.getJobIdsForGroup(self.group_id):
+            job_info = tracker.getJobInfo(spark_job_id)
+            if job_info is None:
+                continue
+            for stage_id in job_info.stageIds:
+                stages_total += 1
+                stage = tracker.getStageInfo(stage_id)
+                if stage is None:
+                    continue
+                tasks_total += stage.numTasks
+                tasks_completed += stage.numCompletedTasks
+                tasks_active += stage.numActiveTasks
+                tasks_failed += stage.numFailedTasks
+                if stage.numTasks and stage.numCompletedTasks >= stage.numTasks:
+                    stages_completed += 1
+        return {
+            "stagesTotal": stages_total,
+            "stagesCompleted": stages_completed,
+            "tasksTotal": tasks_total,
+            "tasksCompleted": tasks_completed,
+            "tasksActive": tasks_active,
+            "tasksFailed": tasks_failed,
+        }
+
+    def record(self) -> dict:
+        return {
+            "jobId": self.id,
+            "status": self.status,
+            "query": self.query,
+            "submittedAt": self.submitted_at,
+            "finishedAt": self.finished_at,
+            "error": self.error,
+        }
+
+    def snapshot(self) -> dict:
+        self.sync()
+        return {**self.record(), "progress": self.progress() if self.status == "running" else None}
+
+
+class RemoteJob:
+    """A job submitted through another worker, read from its shared record."""
+
+    def __init__(self, record: dict):
+        self.id = record["jobId"]
+        self._record = record
+
+    @property
+    def status(self) -> str:
+        return self._record["status"]
+
+    @property
+    def error(self) -> Optional[str]:
+        return self._record["error"]
+
+    @property
+    def result(self) -> Optional[dict]:
+        text = _read_text(_job_result_uri(self.id))
+        return json.loads(text) if text else None
+
+    def sync(self) -> None:
+        self._record = _job_records.get(self.id) or self._record
+
+    def snapshot(self) -> dict:
+        self.sync()
+        return {**self._record, "progress": None}
+
+    def cancel(self) -> None:
+        def mark(record: Optional[dict]) -> Optional[dict]:
+            if record and record["status"] not in QueryJob.TERMINAL:
+                return {**record, "status": "cancelled", "finishedAt": time.time()}
+            return record
+
+        self._record = _job_records.modify(self.id, mark) or self._record
+        if self.status == "cancelled":
+            # Operation tags are per session, so any worker can interrupt the job
+            _cancel_group(f"job-{self.id}")
+
+
+_jobs: Dict[str, QueryJob] = {}
+_jobs_lock = threading.Lock()
+# Spark Connect mode: job records (jobId -> state) every worker sees, with the
+# results under TABLE_STORE_DIR/_jobs, so any worker can serve or cancel a job
+_job_records: Optional[MutableMapping] = _shared_state("_jobs.json") if SPARK_CONNECT_URL else None
+
+
+def _job_result_uri(job_id: str) -> str:
+    return _storage_uri("_jobs", f"{job_id}.json", root=TABLE_STORE_DIR)
+
+
+def _purge_expired_jobs() -> None:
+    cutoff = time.time() - QUERY_JOB_TTL_SECONDS
+    with _jobs_lock:
+        for job_id in [j.id for j in _jobs.values() if j.finished_at and j.finished_at < cutoff]:
+            del _jobs[job_id]
+    if _job_records is None:
+        return
+    for job_id, record in list(_job_records.items()):
+        # A job whose worker died never finishes; none runs longer than this
+        finished = record["finishedAt"] or record["submittedAt"] + ADMISSION_MAX_WAIT_SECONDS + REQUEST_TIMEOUT_SECONDS
+        if finished < cutoff:
+            _job_records.pop(job_id, None)
+            try:
+                os.remove(_job_result_uri(job_id)[len("file://"):])
+            except FileNotFoundError:
+                pass
+
+
+def _get_job(job_id: str):
+    """The job, owned by this worker or (Spark Connect mode) another one, or None."""
+    _purge_expired_jobs()
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None and _job_records is not None:
+        record = _job_records.get(job_id)
+        job = RemoteJob(record) if record else None
+    return job
+
+
+def _job_not_found(job_id: str) -> JSONResponse:
+    return JSONResponse(status_code=404, content={"detail": f"Unknown or expired job '{job_id}'"})
+
+
+@app.post("/jobs")
+async def submit_job(
+    request: Request,
+    query: str = Form(...),
+    format: Optional[str] = Form(None),
+    offset: int = Form(0),
+    approx: bool = Form(False),
+):
+    _purge_expired_jobs()
+    try:
+        fmt = _result_format(format)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+    client = _client_id(request)
+    try:
+        _require_spark()
+        admitted = admission.enqueue(client)
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    job = QueryJob(query, fmt, max(0, offset), approx)
+    with _jobs_lock:
+        _jobs[job.id] = job
+    await run_in_threadpool(job._publish)
+    asyncio.ensure_future(job.admit_and_run(client, admitted))
+    return JSONResponse(status_code=202, content={"jobId": job.id, "status": job.status})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = _get_job(job_id)
+    if job is None:
+        return _job_not_found(job_id)
+    return await run_in_threadpool(job.snapshot)
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    job = _get_job(job_id)
+    if job is None:
+        return _job_not_found(job_id)
+
+    async def events():
+        while True:
+            snapshot = await run_in_threadpool(job.snapshot)
+            yield f"data: {json.dumps(snapshot)}\n\n"
+            if snapshot["status"] in QueryJob.TERMINAL:
+                break
+            await asyncio.sleep(QUERY_JOB_PROGRESS_INTERVAL_SECONDS)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(request: Request, job_id: str):
+    job = _get_job(job_id)
+    if job is None:
+        return _job_not_found(job_id)
+    await run_in_threadpool(job.sync)
+    if job.status == "succeeded":
+        result = await run_in_threadpool(lambda: job.result)
+        return await run_in_threadpool(_encode_result, result, request.headers.get("accept-encoding", ""))
+    if job.status == "failed":
+        return JSONResponse(status_code=400, content={"detail": f"Query error: {job.error}"})
+    if job.status == "cancelled":
+        return JSONResponse(status_code=410, content={"detail": "Job was cancelled"})
+    return JSONResponse(status_code=409, content={"detail": f"Job is still {job.status}"})
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = _get_job(job_id)
+    if job is None:
+        return _job_not_found(job_id)
+    await run_in_threadpool(job.cancel)
+    return {"jobId": job.id, "status": job.status}
+
+
+def _ndjson_batches(query: str, group_id: str, limit: Optional[int]):
+    """Yield NDJSON chunks: a header line with the columns, then the rows.
+
+    ``toLocalIterator`` fetches one partition at a time, so the driver and the
+    backend only hold the partition being sent.
+    """
+    with _job_group(group_id, "stream query"):
+        df = spark.sql(query)
+        if limit:
+            df = df.limit(limit)
+        # The iterator's serving thread inherits the job group when it is created here
+        rows = df.toLocalIterator(prefetchPartitions=True)
+    yield json.dumps({"columns": df.columns}) + "\n"
+    batch = []
+    sent = 0
+    for row in rows:
+        batch.append(json.dumps(row.asDict(recursive=True), default=str))
+        if len(batch) >= STREAM_BATCH_ROWS:
+            sent += len(batch)
+            yield "\n".join(batch) + "\n"
+            batch = []
+    if batch:
+        sent += len(batch)
+        yield "\n".join(batch) + "\n"
+    RESULT_ROWS.labels("/query/stream").observe(sent)
+
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+# End-of-stream marker of the Arrow IPC streaming format
+_ARROW_EOS = b"\xff\xff\xff\xff\x00\x00\x00\x00"
+
+
+def _arrow_batches(query: str, group_id: str, limit: Optional[int]):
+    """Yield an Arrow IPC stream: the schema message, then one message per record batch.
+
+    Executors convert their partitions to Arrow and serialize each batch, and
+    ``toLocalIterator`` fetches one partition at a time. The backend forwards
+    the bytes without decoding them.
+    """
+    with _job_group(group_id, "arrow query"):
+        df = spark.sql(query)
+        if limit:
+            df = df.limit(limit)
+        schema = to_arrow_schema(df.schema)
+
+        # Nested so cloudpickle ships it by value; executors cannot import this module
+        def serialize(batches):
+            import pyarrow as pa
+            for batch in batches:
+                yield pa.RecordBatch.from_arrays([pa.array([batch.serialize().to_pybytes()], pa.binary())], ["batch"])
+
+        rows = df.mapInArrow(serialize, "batch binary").toLocalIterator(prefetchPartitions=True)
+    yield schema.serialize().to_pybytes()
+    for row in rows:
+        yield bytes(row.batch)
+    yield _ARROW_EOS
+
+
+def _wants_arrow(request: Request) -> bool:
+    return ARROW_STREAM_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def _stream_response(request: Request, batches, group_id: str, media_type: str) -> Response:
+    """Stream a generator of Spark result chunks while holding an admission slot."""
+    loop = asyncio.get_running_loop()
+    done = object()
+    client = _client_id(request)
+    try:
+        _require_spark()
+        # The slot is held until the stream ends
+        await admission.admit(client)
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+
+    try:
+        # Run the first step eagerly so analysis errors become a 400, not a broken stream
+        first = await loop.run_in_executor(spark_pool, next, batches, done)
+    except Exception as e:
+        admission.release(client)
+        return JSONResponse(status_code=400, content={"detail": f"Query error: {e}"})
+
+    async def body():
+        chunk = first
+        try:
+            while chunk is not done:
+                yield chunk
+                chunk = await loop.run_in_executor(spark_pool, next, batches, done)
+        finally:
+            # No-op when the stream finished; stops the jobs if the client went away
+            _cancel_group(group_id)
+            admission.release(client)
+
+    return StreamingResponse(body(), media_type=media_type)
+
+
+@app.post("/query/stream")
+async def stream_query(request: Request, query: str = Form(...), limit: Optional[int] = Form(None)):
+    group_id = f"stream-{uuid.uuid4().hex}"
+    return await _stream_response(
+        request, _ndjson_batches(query, group_id, limit), group_id, "application/x-ndjson"
+    )
+
+
+class ResultCursor:
+    """A server-side cursor over a query result, read page by page.
+
+    In Spark Connect mode its query and position are shared, so a fetch that
+    lands on another worker reopens the query there at that offset.
+    """
+
+    def __init__(self, query: str, cursor_id: Optional[str] = None, position: int = 0):
+        self.id = cursor_id or uuid.uuid4().hex
+        self.query = query
+        self.columns: List[str] = []
+        self.rows = None
+        self.position = position
+        self.exhausted = False
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+        # Per iterator, so releasing this worker's copy leaves other workers' running
+        self.group_id = f"cursor-{uuid.uuid4().hex}"
+
+    def _reopen(self) -> None:
+        """Start the iterator at the current position; open() and fetch() run
+        under the cursor's job group, which the iterator's serving thread inherits."""
+        df = spark.sql(self.query)
+        if self.position:
+            df = df.offset(self.position)
+        self.columns, self.rows = df.columns, df.toLocalIterator(prefetchPartitions=True)
+
+    def _publish(self) -> None:
+        if _cursor_records is None:
+            return
+        if self.exhausted:
+            _cursor_records.pop(self.id, None)
+            _remove_shared_lock("_cursors", self.id)
+        else:
+            _cursor_records[self.id] = {
+                "query": self.query, "columns": self.columns, "position": self.position, "lastUsed": self.last_used,
+            }
+
+    def open(self) -> None:
+        self._reopen()
+        self._publish()
+
+    def fetch(self, size: int) -> dict:
+        """The next page; raises KeyError if the cursor was closed through another worker."""
+        with self.lock, _shared_lock("_cursors", self.id):
+            self.last_used = time.time()
+            if _cursor_records is not None:
+                record = _cursor_records.get(self.id)
+                if record is None:
+                    raise KeyError(self.id)
+                if record["position"] != self.position:
+                    # Another worker has read on; continue from there
+                    self.position, self.rows = record["position"], None
+            if self.rows is None and not self.exhausted:
+                self._reopen()
+            page = [] if self.exhausted else [
+                row.asDict(recursive=True) for row in itertools.islice(self.rows, size)
+            ]
+            offset = self.position
+            self.position += len(page)
+            if len(page) < size:
+                self.exhausted = True
+                self.rows = None
+            self._publish()
+            return {
+                "cursorId": self.id,
+                "columns": self.columns,
+                "data": page,
+                "offset": offset,
+                "done": self.exhausted,
+            }
+
+    def release(self) -> None:
+        """Drop this worker's iterator."""
+        self.rows = None
+        _cancel_group(self.group_id)
+
+    def close(self) -> None:
+        self.exhausted = True
+        self.release()
+        self._publish()
+
+
+_cursors: Dict[str, ResultCursor] = {}
+_cursors_lock = threading.Lock()
+# Spark Connect mode: cursorId -> query, columns, position and last use, for every worker
+_cursor_records: Optional[MutableMapping] = _shared_state("_cursors.json") if SPARK_CONNECT_URL else None
+
+
+def _purge_idle_cursors() -> None:
+    cutoff = time.time() - CURSOR_IDLE_TTL_SECONDS
+    if _cursor_records is not None:
+        for cursor_id, record in list(_cursor_records.items()):
+            if record["lastUsed"] < cutoff:
+                _cursor_records.pop(cursor_id, None)
+                _remove_shared_lock("_cursors", cursor_id)
+    with _cursors_lock:
+        idle = [
+            c for c in _cursors.values()
+            if c.last_used < cutoff or (_cursor_records is not None and c.id not in _cursor_records)
+        ]
+        for cursor in idle:
+            del _cursors[cursor.id]
+    for cursor in idle:
+        cursor.release()
+
+
+def _open_cursors() -> int:
+    with _cursors_lock:
+        return len(_cursors) if _cursor_records is None else len(_cursor_records)
+
+
+def _get_cursor(cursor_id: str) -> Optional[ResultCursor]:
+    """The cursor, adopting one opened through another worker in Spark Connect mode."""
+    with _cursors_lock:
+        cursor = _cursors.get(cursor_id)
+        if cursor is None and _cursor_records is not None:
+            record = _cursor_records.get(cursor_id)
+            if record is not None:
+                cursor = ResultCursor(record["query"], cursor_id, record["position"])
+                cursor.columns = record["columns"]
+                _cursors[cursor_id] = cursor
+        return cursor
+
+
+def _cursor_not_found(cursor_id: str) -> JSONResponse:
+    return JSONResponse(status_code=404, content={"detail": f"Unknown or expired cursor '{cursor_id}'"})
+
+
+@app.post("/cursors")
+async def open_cursor(request: Request, query: str = Form(...)):
+    if not spark_startup.ready:
+        return _cancelled_response(SparkNotReady())
+    await run_in_threadpool(_purge_idle_cursors)
+    if await run_in_threadpool(_open_cursors) >= MAX_OPEN_CURSORS:
+        return JSONResponse(status_code=429, content={"detail": "Too many open cursors"})
+    cursor = ResultCursor(query)
+    try:
+        await run_spark(request, f"cursor {cursor.id}", cursor.open, group_id=cursor.group_id)
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"detail": f"Query error: {e}"})
+    with _cursors_lock:
+        _cursors[cursor.id] = cursor
+    return {"cursorId": cursor.id, "columns": cursor.columns}
+
+
+@app.get("/cursors/{cursor_id}")
+async def fetch_cursor(request: Request, cursor_id: str, size: int = 100):
+    await run_in_threadpool(_purge_idle_cursors)
+    cursor = await run_in_threadpool(_get_cursor, cursor_id)
+    if cursor is None:
+        return _cursor_not_found(cursor_id)
+    size = max(1, min(size, CURSOR_MAX_PAGE_SIZE))
+    try:
+        page = await run_spark(request, f"cursor {cursor_id}", cursor.fetch, size, group_id=cursor.group_id)
+    except SparkJobCancelled as e:
+        if not isinstance(e, (AdmissionRejected, SparkNotReady)):
+            # The iterator was interrupted mid-page, so the cursor cannot go on
+            with _cursors_lock:
+                _cursors.pop(cursor_id, None)
+            await run_in_threadpool(cursor.close)
+        return _cancelled_response(e)
+    except KeyError:
+        with _cursors_lock:
+            _cursors.pop(cursor_id, None)
+        return _cursor_not_found(cursor_id)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"detail": f"Query error: {e}"})
+    if page["done"]:
+        with _cursors_lock:
+            _cursors.pop(cursor_id, None)
+    return page
+
+
+@app.delete("/cursors/{cursor_id}")
+async def close_cursor(cursor_id: str):
+    cursor = await run_in_threadpool(_get_cursor, cursor_id)
+    if cursor is None:
+        return _cursor_not_found(cursor_id)
+    with _cursors_lock:
+        _cursors.pop(cursor_id, None)
+    await run_in_threadpool(cursor.close)
+    return {"cursorId": cursor_id, "closed": True}
+
+
+# Materialized views: stored as Parquet under TABLE_STORE_DIR/_views and
+# registered under their own name. Views whose SELECT list is plain group keys
+# plus SUM/COUNT/MIN/MAX aggregates are refreshed incrementally on append by
+# aggregating only the new rows and merging them into the stored result.
+view_manifest = JsonManifest(_storage_uri("_views.json", root=TABLE_STORE_DIR))
+
+_MERGE_FUNCTIONS = {"sum": F.sum, "count": F.sum, "min": F.min, "max": F.max}
+_MERGEABLE_AGG = re.compile(r"^(sum|count|min|max)\s*\((?!\s*distinct\b)(.*)\)$", re.S)
+_PLAIN_COLUMN = re.compile(r"^`?\w+`?(\.`?\w+`?)?$")
+_TRAILING_ALIAS = re.compile(r"\s+(?:as\s+)?`?\w+`?$", re.S)
+# Outer, semi and anti joins are excluded: appended rows can retract null-extended
+# or filtered rows that an already stored aggregate has counted
+_NOT_INCREMENTAL = re.compile(
+    r"\b(having|limit|union|intersect|except|over|distinct|order\s+by|left|right|full|outer|semi|anti"
+    r"|rollup|cube|grouping)\b|\(\s*select\b"
+)
+
+
+def _split_top_level(text: str) -> List[str]:
+    """Split ``text`` on commas outside parentheses and string literals."""
+    items, depth, current, quote = [], 0, [], None
+    for ch in text:
+        if quote:
+            quote = None if ch == quote else quote
+        elif ch in "'\"`":
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            items.append("".join(current).strip())
+            current = []
+            continue
+        current.append(ch)
+    items.append("".join(current).strip())
+    return items
+
+
+def _incremental_plan(query: str, columns: List[str]) -> Optional[dict]:
+    """Group keys and mergeable aggregates of a view, or None if it needs full recomputes."""
+    sql = normalize_sql(query)
+    match = re.match(r"^select\s+(.*?)\s+from\s+(.*)\s+group\s+by\s+(.*)$", sql, re.S)
+    if not match or _NOT_INCREMENTAL.search(_SQL_LITERAL.sub("''", sql)):
+        return None
+    items = _split_top_level(match.group(1))
+    if len(items) != len(columns):
+        return None
+    keys, aggregates, key_exprs = [], {}, {}
+    for position, (item, column) in enumerate(zip(items, columns), 1):
+        expr = _TRAILING_ALIAS.sub("", item) if not _PLAIN_COLUMN.match(item) else item
+        agg = _MERGEABLE_AGG.match(expr)
+        if agg and "(" not in agg.group(2).replace("(*)", ""):
+            aggregates[column] = agg.group(1)
+        elif _PLAIN_COLUMN.match(expr):
+            keys.append(column)
+            key_exprs[str(position)] = key_exprs[column.lower()] = expr.replace("`", "")
+        else:
+            return None
+    # Merging regroups the stored rows by the selected keys, which is only the
+    # same grouping when the view groups by exactly those keys
+    grouping = set()
+    for expr in _split_top_level(match.group(3)):
+        expr = expr.replace("`", "")
+        grouping.add(key_exprs.get(expr, expr))
+    if grouping != {key_exprs[column.lower()] for column in keys}:
+        return None
+    return {"keys": keys, "aggregates": aggregates} if aggregates else None
+
+
+def _replace_table(query: str, table: str, replacement: str) -> Tuple[str, int]:
+    """Substitute a table name outside string literals; returns the SQL and FROM/JOIN references."""
+    pattern = re.compile(rf"(?<![\w.`])`?{re.escape(table)}`?(?![\w`])", re.I)
+    parts = _SQL_LITERAL.split(query)
+    references = sum(
+        len(re.findall(rf"(?<![\w.`])`?{re.escape(table)}`?(?![\w`])(?!\s*\.)", part, re.I))
+        for part in parts[::2]
+    )
+    replaced = [part if i % 2 else pattern.sub(replacement, part) for i, part in enumerate(parts)]
+    return "".join(replaced), references
+
+
+class MaterializedView:
+    def __init__(self, name: str, query: str, sources: List[str]):
+        self.name = name
+        self.query = query
+        self.sources = sources
+        self.plan: Optional[dict] = None
+        self.path: Optional[str] = None
+        self.row_count: Optional[int] = None
+        self.refreshed_at: Optional[float] = None
+        self.full_refreshes = 0
+        self.incremental_refreshes = 0
+        self.error: Optional[str] = None
+        self.lock = threading.Lock()
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "query": self.query,
+            "sources": self.sources,
+            "incremental": self.plan is not None,
+            "rowCount": self.row_count,
+            "refreshedAt": self.refreshed_at,
+            "fullRefreshes": self.full_refreshes,
+            "incrementalRefreshes": self.incremental_refreshes,
+            "error": self.error,
+        }
+
+    def _store(self, df: DataFrame) -> None:
+        path = _storage_uri("_views", self.name, uuid.uuid4().hex, root=TABLE_STORE_DIR)
+        df.write.mode("overwrite").option("compression", PARQUET_COMPRESSION).parquet(path)
+        stored = spark.read.schema(df.schema).parquet(path)
+        stored.createOrReplaceTempView(self.name)
+        self.row_count = stored.count()
+        self.path, self.refreshed_at, self.error = path, time.time(), None
+        _remove_siblings(_storage_uri("_views", self.name, root=TABLE_STORE_DIR), path.rsplit("/", 1)[-1])
+        result_cache.invalidate(self.name)
+        catalog_index.put_table(self.name, stored.dtypes)
+        view_manifest.put(self.name, {
+            "query": self.query,
+            "sources": self.sources,
+            "path": path,
+            "schema": stored.schema.json(),
+            "rowCount": self.row_count,
+            "refreshedAt": self.refreshed_at,
+        })
+
+    def refresh(self) -> None:
+        """Recompute the view from its source tables."""
+        with self.lock, _shared_lock("_views", self.name):
+            df = spark.sql(self.query)
+            self.plan = _incremental_plan(self.query, df.columns)
+            self._store(df)
+            self.full_refreshes += 1
+
+    def apply_delta(self, table: str, delta: DataFrame) -> None:
+        """Merge the aggregate of rows appended to ``table``; falls back to a full refresh."""
+        delta_view = f"__delta_{uuid.uuid4().hex}"
+        delta_query, references = _replace_table(self.query, table, delta_view)
+        if self.plan is None or references != 1 or self.path is None:
+            self.refresh()
+            return
+        with self.lock, _shared_lock("_views", self.name):
+            delta.createOrReplaceTempView(delta_view)
+            try:
+                current = spark.table(self.name)
+                merged = (
+                    current.unionByName(spark.sql(delta_query))
+                    .groupBy(*self.plan["keys"])
+                    .agg(*[_MERGE_FUNCTIONS[kind](c).alias(c) for c, kind in self.plan["aggregates"].items()])
+                    .select(*current.columns)
+                )
+                self._store(merged)
+                self.incremental_refreshes += 1
+            finally:
+                spark.catalog.dropTempView(delta_view)
+
+
+_views: Dict[str, MaterializedView] = {}
+_views_lock = threading.Lock()
+
+
+def _view_from_entry(name: str, entry: dict) -> MaterializedView:
+    view = MaterializedView(name, entry["query"], entry["sources"])
+    view.path, view.row_count, view.refreshed_at = entry["path"], entry.get("rowCount"), entry.get("refreshedAt")
+    view.plan = _incremental_plan(view.query, T.StructType.fromJson(json.loads(entry["schema"])).fieldNames())
+    return view
+
+
+def _sync_views() -> None:
+    """Spark Connect mode: adopt views created, refreshed or dropped by other workers."""
+    if not SPARK_CONNECT_URL:
+        return
+    entries = view_manifest.load()
+    with _views_lock:
+        for name in [n for n in _views if n not in entries]:
+            del _views[name]
+        for name, entry in entries.items():
+            view = _views.get(name)
+            if view is None:
+                _views[name] = _view_from_entry(name, entry)
+            elif entry.get("refreshedAt") != view.refreshed_at:
+                view.path, view.row_count, view.refreshed_at = entry["path"], entry.get("rowCount"), entry.get("refreshedAt")
+
+
+def _dependent_views(table: str) -> List[MaterializedView]:
+    _sync_views()
+    with _views_lock:
+        return [v for v in _views.values() if table.lower() in v.sources]
+
+
+def _refresh_in_background(view: MaterializedView) -> None:
+    def run():
+        try:
+            view.refresh()
+        except Exception as e:
+            view.error = str(e)
+            logger.warning("Refreshing materialized view %s failed: %s", view.name, e)
+
+    spark_pool.submit(run)
+
+
+def _refresh_dependent_views(table: str) -> None:
+    """A source table was replaced: recompute dependent views in the background."""
+    for view in _dependent_views(table):
+        _refresh_in_background(view)
+
+
+def _on_table_appended(table: str, delta: DataFrame) -> None:
+    """Rows in ``delta`` were appended to ``table``: fold them into dependent views."""
+    for view in _dependent_views(table):
+        try:
+            view.apply_delta(table, delta)
+        except Exception as e:
+            view.error = str(e)
+            logger.warning("Incremental refresh of %s failed, recomputing: %s", view.name, e)
+            _refresh_in_background(view)
+
+
+def _restore_materialized_views(registered: Collection[str] = ()) -> None:
+    for name, entry in view_manifest.load().items():
+        try:
+            if name not in registered:
+                schema = T.StructType.fromJson(json.loads(entry["schema"]))
+                spark.read.schema(schema).parquet(entry["path"]).createOrReplaceTempView(name)
+                result_cache.invalidate(name)
+            view = _view_from_entry(name, entry)
+            with _views_lock:
+                _views[name] = view
+        except Exception as e:
+            logger.warning("Could not restore materialized view %s: %s", name, e)
+
+
+def _create_view(name: str, query: str) -> dict:
+    tables = {t.name.lower() for t in spark.catalog.listTables()}
+    _sync_views()
+    with _views_lock:
+        if name in _views:
+            raise ValueError(f"Materialized view '{name}' already exists")
+    if name.lower() in tables:
+        raise ValueError(f"A table named '{name}' already exists")
+    identifiers = set(_SQL_IDENTIFIER.findall(_SQL_LITERAL.sub("", normalize_sql(query))))
+    view = MaterializedView(name, query, sorted(identifiers & tables))
+    view.refresh()
+    with _views_lock:
+        _views[name] = view
+    return view.describe()
+
+
+def _drop_view(name: str) -> dict:
+    _sync_views()
+    with _views_lock:
+        view = _views.pop(name, None)
+    if view is None:
+        raise KeyError(name)
+    spark.catalog.dropTempView(name)
+    view_manifest.remove(name)
+    _remove_siblings(_storage_uri("_views", name, root=TABLE_STORE_DIR), "")
+    result_cache.forget(name)
+    catalog_index.invalidate()
+    return {"name": name, "dropped": True}
+
+
+def _view_not_found(name: str) -> JSONResponse:
+    return JSONResponse(status_code=404, content={"detail": f"Unknown materialized view '{name}'"})
+
+
+@app.post("/views")
+async def create_view(request: Request, name: str = Form(...), query: str = Form(...)):
+    name = _sanitize_table_name(name)
+    try:
+        return await run_spark(request, f"create view {name}", _create_view, name, query)
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"detail": f"Create view failed: {e}"})
+
+
+@app.get("/views")
+async def list_views():
+    await run_in_threadpool(_sync_views)
+    with _views_lock:
+        views = list(_views.values())
+    return {"views": [v.describe() for v in views]}
+
+
+@app.post("/views/{name}/refresh")
+async def refresh_view(request: Request, name: str):
+    await run_in_threadpool(_sync_views)
+    with _views_lock:
+        view = _views.get(name)
+    if view is None:
+        return _view_not_found(name)
+    try:
+        await run_spark(request, f"refresh view {name}", view.refresh)
+        return view.describe()
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"detail": f"Refresh failed: {e}"})
+
+
+@app.delete("/views/{name}")
+async def drop_view(request: Request, name: str):
+    try:
+        return await run_spark(request, f"drop view {name}", _drop_view, name)
+    except KeyError:
+        return _view_not_found(name)
+    except SparkJobCancelled as e:
+        return _cancelled_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": f"Drop view failed: {e}"})
+
+
+# Approximate queries: SELECTs with COUNT(DISTINCT x) swap in HyperLogLog
+# sketches over the full data; other simple SELECTs read a Bernoulli sample of
+# their largest table and scale SUM/COUNT back up. Error bounds are 95%
+# half-widths, from the Horvitz-Thompson variance for scaled sums and counts
+# and from the sketch's relative standard deviation for distinct counts.
+_APPROX_Z = 1.96
+_COUNT_DISTINCT = re.compile(r"\bcount\s*\(\s*distinct\s+([^(),]+(?:\([^()]*\)[^(),]*)*)\)")
+_SCALABLE_AGG = re.compile(r"^(sum|count)\s*\((?!\s*distinct\b)(.*)\)$", re.S)
+_UNSCALED_AGG = re.compile(r"^(avg|mean|min|max)\s*\((.*)\)$", re.S)
+_AGGREGATE_CALL = re.compile(
+    r"\b(sum|count|avg|mean|min|max|stddev\w*|variance|var_\w+|median|percentile\w*|collect_\w+|approx_\w+)\s*\("
+)
+_EXPLICIT_ALIAS = re.compile(r"(?:\s+as\s+|(?<=\))\s+|(?<=\bend)\s+)`?\w+`?$", re.S)
+_NOT_SAMPLEABLE = re.compile(r"\b(having|union|intersect|except|over)\b|\(\s*select\b")
+
+
+def _single_call(args: str) -> bool:
+    """Whether ``args`` is the whole argument list of one call, e.g. not ``x) / count(y``."""
+    depth = 0
+    for ch in _SQL_LITERAL.sub("''", args):
+        depth += {"(": 1, ")": -1}.get(ch, 0)
+        if depth < 0:
+            return False
+    return depth == 0
+
+
+def _approximate_plan(query: str, columns: List[str]) -> dict:
+    """Rewrite ``query`` for approximate execution; mode "exact" (with a reason) when it cannot be."""
+    plan = {
+        "mode": "exact", "reason": None, "columns": columns, "df": None, "view": None,
+        "sampledTable": None, "fraction": 1.0, "bounds": {},
+    }
+    sql = normalize_sql(query)
+    masked = _SQL_LITERAL.sub("''", sql)
+    match = re.match(r"^select\s+(.*?)\s+from\s+(.*)$", sql, re.S)
+    if not match:
+        plan["reason"] = "only SELECT ... FROM queries are approximated"
+        return plan
+    items = _split_top_level(match.group(1))
+    aligned = len(items) == len(columns)
+    exprs = [_EXPLICIT_ALIAS.sub("", item) for item in items]
+
+    if _COUNT_DISTINCT.search(_SQL_LITERAL.sub("''", match.group(1))):
+        if not aligned:
+            plan["reason"] = "the SELECT list could not be matched to the result columns"
+            return plan
+        rewritten = []
+        for i, expr in enumerate(exprs):
+            sketch = _COUNT_DISTINCT.sub(rf"approx_count_distinct(\1, {APPROX_DISTINCT_RSD})", expr)
+            if sketch != expr and _COUNT_DISTINCT.fullmatch(expr):
+                plan["bounds"][i] = ("distinct", None)
+            rewritten.append(sketch)
+        plan.update(mode="sketch", sql=_select_list(rewritten, columns, []) + " from " + match.group(2))
+        return _analyze_approximation(plan)
+
+    if _NOT_SAMPLEABLE.search(masked):
+        plan["reason"] = "HAVING, set operations, window functions and subqueries are not sampled"
+        return plan
+    tables = {t.name.lower() for t in spark.catalog.listTables()}
+    # Estimates only size the sample; scaling uses the sampling fraction itself
+    row_counts = {
+        name.lower(): count
+        for name, count in itertools.chain(_table_row_estimates.items(), _table_row_counts.items())
+        if count
+    }
+    candidates = [t for t in set(_SQL_IDENTIFIER.findall(_SQL_LITERAL.sub("", sql))) & tables if t in row_counts]
+    if not candidates:
+        plan["reason"] = "no referenced table has a known or estimated row count"
+        return plan
+    table = max(candidates, key=row_counts.get)
+    fraction = APPROX_SAMPLE_ROWS / row_counts[table]
+    if fraction >= 1:
+        plan["reason"] = f"'{table}' has no more than {APPROX_SAMPLE_ROWS} rows"
+        return plan
+
+    hidden = []
+    if any(_AGGREGATE_CALL.search(expr) for expr in exprs):
+        if not aligned:
+            plan["reason"] = "the SELECT list could not be matched to the result columns"
+            return plan
+        for i, expr in enumerate(exprs):
+            scalable = _SCALABLE_AGG.match(expr)
+            if scalable and _single_call(scalable.group(2)):
+                if scalable.group(1) == "sum":
+                    hidden.append(f"sum(pow(cast({scalable.group(2)} as double), 2))")
+                    plan["bounds"][i] = ("sum", len(columns) + len(hidden) - 1)
+                else:
+                    plan["bounds"][i] = ("count", None)
+            elif _UNSCALED_AGG.match(expr) and _single_call(_UNSCALED_AGG.match(expr).group(2)):
+                continue
+            elif _AGGREGATE_CALL.search(expr):
+                plan["reason"] = f"'{items[i]}' cannot be scaled from a sample"
+                return plan
+        sql = _select_list(exprs, columns, hidden) + " from " + match.group(2)
+
+    view = f"__approx_{uuid.uuid4().hex}"
+    sampled, references = _replace_table(sql, table, view)
+    if references != 1:
+        plan["reason"] = f"'{table}' is referenced more than once"
+        return plan
+    spark.table(table).sample(fraction=fraction).createOrReplaceTempView(view)
+    plan.update(mode="sample", sql=sampled, view=view, sampledTable=table, fraction=fraction)
+    return _analyze_approximation(plan)
+
+
+def _select_list(exprs: List[str], columns: List[str], hidden: List[str]) -> str:
+    """A SELECT list that keeps the original column names, followed by helper columns."""
+    named = [f"{expr} AS `{column.replace('`', '``')}`" for expr, column in zip(exprs, columns)]
+    named += [f"{expr} AS `__approx_{i}`" for i, expr in enumerate(hidden)]
+    return "select " + ", ".join(named)
+
+
+def _analyze_approximation(plan: dict) -> dict:
+    """Resolve the rewritten SQL, falling back to exact execution if Spark rejects it."""
+    try:
+        plan["df"] = spark.sql(plan["sql"])
+    except Exception as e:
+        logger.debug("Approximate rewrite rejected, running exactly: %s", e)
+        if plan["view"]:
+            spark.catalog.dropTempView(plan["view"])
+        plan.update(mode="exact", reason="the rewritten query did not analyze", view=None,
+                    sampledTable=None, fraction=1.0, bounds={})
+    return plan
+
+
+def _scale(value, fraction: float):
+    if value is None:
+        return None
+    if isinstance(value, Decimal):
+        return value / Decimal(repr(fraction))
+    if isinstance(value, int):
+        return round(value / fraction)
+    return value / fraction
+
+
+def _approximate_rows(plan: dict, rows: list) -> Tuple[list, Dict[int, list]]:
+    """Scale sampled aggregates, drop helper columns and compute per-row error bounds."""
+    if plan["mode"] == "exact":
+        return rows, {}
+    columns, fraction = plan["columns"], plan["fraction"]
+    bounds = {i: [] for i in plan["bounds"]}
+    make_row = Row(*columns)
+    scaled_rows = []
+    for row in rows:
+        values = list(row)[:len(columns)]
+        for i, (kind, helper) in plan["bounds"].items():
+            value = values[i]
+            if value is None:
+                bounds[i].append(None)
+            elif kind == "distinct":
+                bounds[i].append(_APPROX_Z * APPROX_DISTINCT_RSD * value)
+            else:
+                # Var(x / p) over a Bernoulli(p) sample is (1 - p) / p^2 * sum(x^2)
+                squares = row[helper] if kind == "sum" else value
+                bounds[i].append(_APPROX_Z * ((1 - fraction) * (squares or 0)) ** 0.5 / fraction)
+                values[i] = _scale(value, fraction)
+        scaled_rows.append(make_row(*values))
+    return scaled_rows, bounds
+
+
+def _describe_approximation(plan: dict, bounds: Optional[Dict[int, list]], kept: int) -> dict:
+    return {
+        "mode": plan["mode"],
+        "reason": plan["reason"],
+        "sampledTable": plan["sampledTable"],
+        "sampleFraction": plan["fraction"],
+        "distinctRsd": APPROX_DISTINCT_RSD if plan["mode"] == "sketch" else None,
+        "confidence": 0.95,
+        # Half-widths of 95% confidence intervals, one per returned row
+        "errorBounds": {plan["columns"][i]: values[:kept] for i, values in (bounds or {}).items()},
+    }
@@ -0,0 +1,56 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+
+async def _connected():
+    return False
+
+
+REQUEST = SimpleNamespace(
+    headers={}, client=SimpleNamespace(host="127.0.0.1"), scope={}, is_disconnected=_connected,
+)
+
+
+@pytest.fixture
+def saturated(monkeypatch):
+    """Spark is up, but this client is over its quota: admission rejects every request."""
+    monkeypatch.setattr(server, "spark", SimpleNamespace())
+    monkeypatch.setattr(server.spark_startup, "_ready", SimpleNamespace(is_set=lambda: True))
+    monkeypatch.setattr(server.admission, "per_client", 0)
+    monkeypatch.setattr(server.admission, "max_wait", 0.01)
+
+
+def _catalog(monkeypatch, built_at):
+    monkeypatch.setattr(server.catalog_index, "_dirty", False)
+    monkeypatch.setattr(server.catalog_index, "_built_at", built_at)
+    monkeypatch.setattr(server.catalog_index, "_tables", {
+        "sales": {"name": "sales", "database": None, "isTemporary": True, "columns": [{"name": "amount", "type": "double"}]},
+    })
+    server.catalog_index._reindex()
+
+
+def test_fresh_catalog_is_served_without_admission(saturated, monkeypatch):
+    _catalog(monkeypatch, time.time())
+    completion = asyncio.run(server.complete(REQUEST, prefix="sa"))
+    assert completion["suggestions"][0]["value"] == "sales"
+    assert asyncio.run(server.get_schema(REQUEST))["tables"][0]["name"] == "sales"
+
+
+def test_stale_catalog_is_rebuilt_through_admission(saturated, monkeypatch):
+    _catalog(monkeypatch, 0.0)
+    assert asyncio.run(server.complete(REQUEST, prefix="sa")).status_code == 429
+
+
+def test_cursors_go_through_admission(saturated, monkeypatch):
+    monkeypatch.setattr(server, "_cursor_records", None)
+    assert asyncio.run(server.open_cursor(REQUEST, query="SELECT * FROM sales")).status_code == 429
+
+    cursor = server.ResultCursor("SELECT * FROM sales")
+    monkeypatch.setitem(server._cursors, cursor.id, cursor)
+    assert asyncio.run(server.fetch_cursor(REQUEST, cursor.id)).status_code == 429
+    assert cursor.id in server._cursors  # still open: nothing ran
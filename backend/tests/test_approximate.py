@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+
+class FakeSpark:
+    """Records the views and SQL an approximate rewrite hands to Spark."""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.views = set()
+        self.catalog = SimpleNamespace(listTables=self._list_tables, dropTempView=self.views.discard)
+        self.samples = []
+
+    def _list_tables(self):
+        return [SimpleNamespace(name=name) for name in self.tables]
+
+    def table(self, name):
+        spark = self
+
+        class Table:
+            def sample(self, fraction):
+                spark.samples.append((name, fraction))
+                return SimpleNamespace(createOrReplaceTempView=spark.views.add)
+
+        return Table()
+
+    def sql(self, query):
+        return SimpleNamespace(sql=query)
+
+
+@pytest.fixture
+def spark(monkeypatch):
+    fake = FakeSpark(["sales", "products"])
+    monkeypatch.setattr(server, "spark", fake)
+    monkeypatch.setattr(server, "_table_row_counts", {"sales": 100_000_000, "products": 50})
+    monkeypatch.setattr(server, "_table_row_estimates", {})
+    return fake
+
+
+def test_single_call():
+    assert server._single_call("amount * price")
+    assert server._single_call("coalesce(amount, 0)")
+    assert not server._single_call("a) / count(b")
+
+
+def test_distinct_counts_become_sketches(spark):
+    plan = server._approximate_plan(
+        "SELECT product, COUNT(DISTINCT user_id) AS users FROM sales GROUP BY product", ["product", "users"]
+    )
+    assert plan["mode"] == "sketch"
+    assert f"approx_count_distinct(user_id, {server.APPROX_DISTINCT_RSD}) AS `users`" in plan["sql"]
+    assert plan["bounds"] == {1: ("distinct", None)}
+    assert not spark.samples
+
+
+def test_largest_table_is_sampled_and_sums_get_helpers(spark):
+    plan = server._approximate_plan(
+        "SELECT p.category, SUM(s.amount) AS total, COUNT(*) n FROM sales s JOIN products p ON s.id = p.id "
+        "GROUP BY p.category",
+        ["category", "total", "n"],
+    )
+    assert plan["mode"] == "sample"
+    assert plan["sampledTable"] == "sales"
+    assert spark.samples == [("sales", server.APPROX_SAMPLE_ROWS / 100_000_000)]
+    assert plan["view"] in spark.views
+    assert f"from {plan['view']} s join products p" in plan["sql"]
+    assert "sum(pow(cast(s.amount as double), 2)) AS `__approx_0`" in plan["sql"]
+    assert plan["bounds"] == {1: ("sum", 3), 2: ("count", None)}
+
+
+def test_estimated_row_counts_allow_sampling(spark, monkeypatch):
+    monkeypatch.setattr(server, "_table_row_counts", {"sales": None})
+    monkeypatch.setattr(server, "_table_row_estimates", {"sales": 10 * server.APPROX_SAMPLE_ROWS})
+    plan = server._approximate_plan("select sum(amount) total from sales", ["total"])
+    assert plan["mode"] == "sample"
+    assert plan["fraction"] == pytest.approx(0.1)
+
+
+@pytest.mark.parametrize("query, columns", [
+    ("select category, sum(amount) from sales group by category having sum(amount) > 1", ["category", "s"]),
+    ("select sum(a) / count(b) r from sales", ["r"]),
+    ("select * from sales a join sales b on a.id = b.id", ["id", "id"]),
+    ("select count(*) n from products", ["n"]),
+])
+def test_unsupported_queries_run_exactly(spark, query, columns):
+    plan = server._approximate_plan(query, columns)
+    assert plan["mode"] == "exact"
+    assert plan["reason"]
+    assert not spark.views
+
+
+def test_sampled_rows_are_scaled_with_bounds():
+    plan = {
+        "mode": "sample", "columns": ["category", "total", "n"], "fraction": 0.01,
+        "bounds": {1: ("sum", 3), 2: ("count", None)},
+    }
+    rows, bounds = server._approximate_rows(plan, [("a", 1000, 10, 100000.0), ("b", None, 0, None)])
+    assert [tuple(row) for row in rows] == [("a", 100000, 1000), ("b", None, 0)]
+    assert bounds[1] == [pytest.approx(1.96 * (0.99 * 100000) ** 0.5 / 0.01), None]
+    assert bounds[2] == [pytest.approx(1.96 * (0.99 * 10) ** 0.5 / 0.01), 0.0]
+
+
+def test_sketch_bounds_use_the_relative_error():
+    plan = {"mode": "sketch", "columns": ["users"], "fraction": 1.0, "bounds": {0: ("distinct", None)}}
+    rows, bounds = server._approximate_rows(plan, [(5000,)])
+    assert tuple(rows[0]) == (5000,)
+    assert bounds[0] == [pytest.approx(1.96 * server.APPROX_DISTINCT_RSD * 5000)]
+
+
+def test_csv_rows_are_estimated_from_file_sizes(tmp_path):
+    data = tmp_path / "sales.csv"
+    data.write_text("id,amount\n" + "".join(f"{i},{i % 10}\n" for i in range(1000, 2000)))
+    lines = data.read_text().splitlines()[:11]
+    assert server._estimate_csv_rows(lines, [data.as_uri()]) == pytest.approx(1000, rel=0.01)
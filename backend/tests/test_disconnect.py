@@ -0,0 +1,61 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import server
+
+
+class BlockingSpark:
+    """A session whose queries run until their job group is cancelled."""
+
+    def __init__(self):
+        self.cancelled = []
+        self.released = threading.Event()
+        self.sparkContext = SimpleNamespace(
+            setJobGroup=lambda *args, **kwargs: None,
+            setLocalProperty=lambda *args: None,
+            cancelJobGroup=self._cancel,
+        )
+
+    def _cancel(self, group_id):
+        self.cancelled.append(group_id)
+        self.released.set()
+
+    def sql(self, query):
+        self.released.wait(10)
+        raise RuntimeError("cancelled")
+
+
+def test_disconnected_query_cancels_its_job_group(monkeypatch):
+    fake = BlockingSpark()
+    monkeypatch.setattr(server, "spark", fake)
+    monkeypatch.setattr(server.spark_startup, "_ready", SimpleNamespace(is_set=lambda: True))
+    monkeypatch.setattr(server.result_cache, "max_bytes", 0)
+    monkeypatch.setattr(server, "SPARK_METRICS_ENABLED", False)
+
+    body = b"query=SELECT+count(*)+FROM+sales"
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/query", "raw_path": b"/query", "query_string": b"", "root_path": "",
+        "headers": [
+            (b"host", b"test"),
+            (b"content-type", b"application/x-www-form-urlencoded"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 5000), "server": ("test", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        # The client goes away once the form has been read
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asyncio.wait_for(server.app(scope, receive, send), timeout=10))
+
+    assert len(fake.cancelled) == 1
+    assert fake.cancelled[0].startswith("req-")
+    assert sent[0]["status"] == 499
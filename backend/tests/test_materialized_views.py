@@ -0,0 +1,58 @@
+import server
+
+
+def test_split_top_level_ignores_nested_commas_and_literals():
+    assert server._split_top_level("a, sum(b, c), 'x,y', `d,e`") == ["a", "sum(b, c)", "'x,y'", "`d,e`"]
+
+
+def test_replace_table_skips_literals_and_qualified_columns():
+    sql, references = server._replace_table("select sales.id from sales where note = 'sales'", "sales", "v2")
+    assert sql == "select v2.id from v2 where note = 'sales'"
+    assert references == 1
+
+
+def test_replace_table_counts_self_joins():
+    _, references = server._replace_table("select * from sales a join sales b on a.id = b.id", "sales", "v2")
+    assert references == 2
+
+
+def test_incremental_plan_accepts_grouped_sums():
+    plan = server._incremental_plan(
+        "SELECT category, SUM(amount) AS total, COUNT(*) AS n FROM sales GROUP BY category",
+        ["category", "total", "n"],
+    )
+    assert plan == {"keys": ["category"], "aggregates": {"total": "sum", "n": "count"}}
+
+
+def test_incremental_plan_resolves_ordinals_and_aliases():
+    columns = ["category", "total"]
+    assert server._incremental_plan("select category, sum(amount) total from sales group by 1", columns)
+    assert server._incremental_plan("select s.category, max(amount) total from sales s group by category", columns)
+
+
+def test_incremental_plan_rejects_grouping_beyond_selected_keys():
+    assert server._incremental_plan(
+        "SELECT category, SUM(amount) AS total FROM sales GROUP BY category, region", ["category", "total"]
+    ) is None
+
+
+def test_incremental_plan_rejects_grouping_sets():
+    assert server._incremental_plan(
+        "select category, sum(amount) total from sales group by rollup(category)", ["category", "total"]
+    ) is None
+
+
+def test_incremental_plan_rejects_outer_joins():
+    assert server._incremental_plan(
+        "SELECT p.category, COUNT(*) AS n FROM products p LEFT JOIN sales s ON p.id = s.product_id GROUP BY p.category",
+        ["category", "n"],
+    ) is None
+    assert server._incremental_plan(
+        "select p.category, count(*) n from products p left semi join sales s on p.id = s.product_id group by p.category",
+        ["category", "n"],
+    ) is None
+
+
+def test_incremental_plan_rejects_distinct_and_expressions():
+    assert server._incremental_plan("select category, count(distinct id) n from sales group by category", ["category", "n"]) is None
+    assert server._incremental_plan("select category, sum(a) / count(b) r from sales group by category", ["category", "r"]) is None
@@ -0,0 +1,38 @@
+import server
+
+
+def _cache():
+    cache = server.ResultCache(1024 * 1024)
+    cache.invalidate("sales")  # registered by an upload
+    return cache
+
+
+def test_upload_invalidates_queries_on_the_table():
+    cache = _cache()
+    key = cache.key_for("SELECT count(*) FROM sales", lambda: ["sales"])
+    cache.put(key, {"data": [[5]]})
+    assert cache.get(key) == {"data": [[5]]}
+    cache.invalidate("sales")
+    assert cache.get(key) is None
+    assert cache.key_for("SELECT count(*) FROM sales", lambda: ["sales"]) != key
+
+
+def test_queries_on_sql_views_are_not_cached():
+    # CREATE TEMP VIEW v AS SELECT * FROM sales, run through /query
+    cache = _cache()
+    assert cache.key_for("SELECT count(*) FROM v", lambda: ["sales", "v"]) is None
+
+
+def test_view_under_a_dropped_table_name_is_not_cached():
+    cache = _cache()
+    cache.forget("sales")
+    assert cache.key_for("SELECT count(*) FROM sales", lambda: ["sales"]) is None
+
+
+def test_catalog_is_not_listed_for_uncacheable_queries():
+    def views():
+        raise AssertionError("catalog listed")
+
+    cache = _cache()
+    assert cache.key_for("SELECT rand() FROM sales", views) is None
+    assert cache.key_for("DROP VIEW v", views) is None
@@ -0,0 +1,42 @@
+import json
+from datetime import date
+from decimal import Decimal
+
+from pyspark.sql import Row
+
+import server
+
+ROWS = [Row(product="Apple", amount=Decimal("12.50"), day=date(2024, 1, 2)), Row(product="Pear", amount=None, day=None)]
+COLUMNS = ["product", "amount", "day"]
+
+
+def test_rows_layout_is_valid_json():
+    layout, kept = server._serialize_result(ROWS, COLUMNS, "rows", 0)
+    assert kept == 2
+    assert json.loads(layout["data"]) == [
+        {"product": "Apple", "amount": 12.5, "day": "2024-01-02"},
+        {"product": "Pear", "amount": None, "day": None},
+    ]
+
+
+def test_columnar_layout_is_valid_json():
+    layout, _ = server._serialize_result(ROWS, COLUMNS, "columnar", 0)
+    assert json.loads(layout["data"]) == [["Apple", "Pear"], [12.5, None], ["2024-01-02", None]]
+    empty, kept = server._serialize_result([], COLUMNS, "columnar", 0)
+    assert kept == 0
+    assert json.loads(empty["data"]) == [[], [], []]
+
+
+def test_byte_budget_keeps_at_least_one_row():
+    layout, kept = server._serialize_result(ROWS, COLUMNS, "rows", 10)
+    assert kept == 1
+    assert len(json.loads(layout["data"])) == 1
+
+
+def test_encoded_body_splices_raw_data():
+    layout, _ = server._serialize_result(ROWS, COLUMNS, "rows", 0)
+    body = json.loads(server._dump_json({"columns": COLUMNS, **layout, "cached": False}))
+    assert body["columns"] == COLUMNS
+    assert body["data"][0]["product"] == "Apple"
+    assert body["cached"] is False
+    assert json.loads(server._dump_json({"data": server.RawJson("[]")})) == {"data": []}
@@ -0,0 +1,112 @@
+import io
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from pyspark.sql import Row
+from pyspark.sql import types as T
+
+import server
+
+
+def _upload(text):
+    return pd.read_csv(io.StringIO(text))
+
+
+def _schema(**types):
+    return T.StructType([T.StructField(name, data_type, True) for name, data_type in types.items()])
+
+
+def test_memory_append_onto_integer_table():
+    # Table created by /ingest (or stream mode), where Spark inferred IntegerType
+    existing = _schema(id=T.IntegerType(), amount=T.DoubleType())
+    pdf = _upload("id,amount\n1,9.5\n2,3\n")
+    assert pdf["id"].dtype == "int64"
+    drift = server._pandas_drift(pdf, existing)
+    assert drift is None
+    server._check_append_drift("sales", drift, existing=object())
+
+
+def test_memory_append_out_of_integer_range_is_rejected():
+    existing = _schema(id=T.IntegerType(), amount=T.DoubleType())
+    drift = server._pandas_drift(_upload(f"id,amount\n1,9.5\n{2 ** 31},3\n"), existing)
+    assert drift == {"typeChanged": [{"column": "id", "registered": "int", "observed": "int64"}]}
+    with pytest.raises(server.SchemaDriftError):
+        server._check_append_drift("sales", drift, existing=object())
+
+
+# Schema inferred by /ingest, registered before memory-mode uploads of the same table
+INGESTED = _schema(id=T.IntegerType(), day=T.DateType(), amount=T.DoubleType(), region=T.StringType())
+
+
+def test_memory_upload_matches_ingested_schema():
+    pdf = _upload("id,day,amount,region\n1,2024-01-02,9.5,north\n2,2024-01-03,3,south\n")
+    assert server._pandas_drift(pdf, INGESTED) is None
+
+
+def test_nullable_integers_and_empty_columns_match():
+    pdf = _upload("id,day,amount,region\n1,2024-01-02,,north\n,2024-01-03,,south\n")
+    assert pdf["id"].dtype == "float64"
+    assert server._pandas_drift(pdf, INGESTED) is None
+
+
+def test_changed_types_drift():
+    pdf = _upload("id,day,amount,region\n1.5,2024-01-02,9.5,north\n2,soon,3,south\n")
+    assert server._pandas_drift(pdf, INGESTED) == {"typeChanged": [
+        {"column": "id", "registered": "int", "observed": "float64"},
+        {"column": "day", "registered": "date", "observed": str(pdf["day"].dtype)},
+    ]}
+
+
+def test_changed_columns_drift():
+    assert server._pandas_drift(_upload("id,day,amount\n1,2024-01-02,9.5\n"), INGESTED) == {
+        "added": [], "removed": ["region"], "reordered": False,
+    }
+    assert server._pandas_drift(_upload("day,id,amount,region\n2024-01-02,1,9.5,north\n"), INGESTED) == {
+        "added": [], "removed": [], "reordered": True,
+    }
+
+
+class _Reader:
+    def __init__(self, rows):
+        self.rows = rows
+        self.schema_used = None
+
+    def schema(self, schema):
+        self.schema_used = schema
+        return self
+
+    def option(self, key, value):
+        return self
+
+    def csv(self, source):
+        return SimpleNamespace(collect=lambda: self.rows)
+
+
+def _spark(monkeypatch, rows):
+    reader = _Reader(rows)
+    monkeypatch.setattr(server, "SPARK_CONNECT_URL", "")
+    monkeypatch.setattr(server, "spark", SimpleNamespace(
+        read=reader, sparkContext=SimpleNamespace(parallelize=lambda lines, slices: lines),
+    ))
+    return reader
+
+
+def test_csv_header_drift_skips_parsing(monkeypatch):
+    reader = _spark(monkeypatch, [])
+    drift = server._csv_drift(["id,amount,day,region,channel", "1,9.5,2024-01-02,north,web"], INGESTED)
+    assert drift == {"added": ["channel"], "removed": [], "reordered": False}
+    assert reader.schema_used is None
+
+
+def test_csv_sample_parsed_with_registered_schema(monkeypatch):
+    lines = ["id,day,amount,region", "1,2024-01-02,9.5,north", "x,2024-01-03,3,south"]
+    reader = _spark(monkeypatch, [
+        Row(id=1, day=None, amount=9.5, region="north", _corrupt_record=None),
+        Row(id=None, day=None, amount=3.0, region="south", _corrupt_record=lines[2]),
+    ])
+    assert server._csv_drift(lines, INGESTED) == {"malformedSampleRows": 1}
+    assert reader.schema_used.fieldNames() == ["id", "day", "amount", "region", "_corrupt_record"]
+
+    reader.rows = reader.rows[:1]
+    assert server._csv_drift(lines, INGESTED) is None
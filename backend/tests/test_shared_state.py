@@ -0,0 +1,48 @@
+import server
+
+
+def _state(tmp_path, name="state.json"):
+    return server.SharedState("file://" + str(tmp_path / name))
+
+
+def test_writes_are_seen_by_other_workers(tmp_path):
+    a, b = _state(tmp_path), _state(tmp_path)
+    a["sales"] = 10
+    assert b.get("sales") == 10
+    b["sales"] += 5
+    assert a["sales"] == 15
+    del a["sales"]
+    assert "sales" not in b
+    assert b.pop("sales", None) is None
+
+
+def test_invalidation_reaches_other_workers_caches(tmp_path):
+    a = server.ResultCache(1024 * 1024, _state(tmp_path))
+    b = server.ResultCache(1024 * 1024, _state(tmp_path))
+    a.invalidate("sales")
+    key = a.key_for("SELECT count(*) FROM sales", lambda: ["sales"])
+    assert b.key_for("SELECT count(*) FROM sales", lambda: ["sales"]) == key
+    b.invalidate("sales")  # an upload through the other worker
+    assert a.key_for("SELECT count(*) FROM sales", lambda: ["sales"]) != key
+    key = a.key_for("SELECT count(*) FROM sales", lambda: ["sales"])
+    b.clear()  # DDL through the other worker while the query ran
+    a.put(key, {"data": [[5]]})
+    assert a.get(key) is None
+
+
+def test_job_cancelled_through_another_worker(tmp_path, monkeypatch):
+    cancelled = []
+    monkeypatch.setattr(server, "_job_records", _state(tmp_path, "jobs.json"))
+    monkeypatch.setattr(server, "_cancel_group", cancelled.append)
+    job = server.QueryJob("SELECT 1")
+    job._publish()
+
+    remote = server._get_job(job.id)  # submitted through another worker
+    assert isinstance(remote, server.RemoteJob)
+    remote.cancel()
+    assert remote.status == "cancelled"
+    assert cancelled == [job.group_id]
+
+    job.run()  # admitted on the owning worker afterwards
+    assert job.status == "cancelled"
+    assert server._job_records[job.id]["status"] == "cancelled"
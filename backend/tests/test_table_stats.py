@@ -0,0 +1,38 @@
+import server
+
+
+def _stats(rows, size, **columns):
+    return {"rowCount": rows, "sizeInBytes": size, "columns": columns, "collectedAt": 0.0}
+
+
+def test_merge_table_stats_adds_counts_and_combines_ranges():
+    previous = _stats(
+        10, 400,
+        amount={"nullCount": 1, "distinctCount": 8, "min": 5, "max": 90, "avgLength": None},
+        product={"nullCount": 0, "distinctCount": 3, "min": "Apple", "max": "Mango", "avgLength": 5.0},
+    )
+    delta = _stats(
+        5, 200,
+        amount={"nullCount": 2, "distinctCount": 3, "min": 1, "max": 40, "avgLength": None},
+        product={"nullCount": 1, "distinctCount": 2, "min": "Banana", "max": "Pear", "avgLength": 8.0},
+    )
+    merged = server._merge_table_stats(previous, delta)
+    assert merged["rowCount"] == 15
+    assert merged["sizeInBytes"] == 600
+    assert merged["columns"]["amount"] == {
+        "nullCount": 3, "distinctCount": 11, "min": 1, "max": 90, "avgLength": None,
+    }
+    product = merged["columns"]["product"]
+    assert (product["min"], product["max"]) == ("Apple", "Pear")
+    assert product["avgLength"] == (5.0 * 10 + 8.0 * 4) / 14
+
+
+def test_merged_distinct_count_never_exceeds_rows():
+    column = {"nullCount": 0, "distinctCount": 10, "min": None, "max": None, "avgLength": None}
+    merged = server._merge_table_stats(_stats(10, 80, id=column), _stats(10, 80, id=column))
+    assert merged["columns"]["id"]["distinctCount"] == 20
+    merged = server._merge_table_stats(_stats(10, 80, id=column), _stats(2, 16, id={**column, "distinctCount": 2}))
+    assert merged["columns"]["id"]["distinctCount"] == 12
+    small = {**column, "distinctCount": 9}
+    merged = server._merge_table_stats(_stats(10, 80, id=small), _stats(0, 0, id={**column, "distinctCount": 9}))
+    assert merged["columns"]["id"]["distinctCount"] == 10
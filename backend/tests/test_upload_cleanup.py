@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+
+class _Body:
+    def read(self, *args):
+        raise AssertionError("body read before the readiness check")
+
+
+def test_upload_while_spark_starts_is_503(monkeypatch):
+    monkeypatch.setattr(server, "spark", None)
+    monkeypatch.setattr(server, "INGEST_STORAGE", "hdfs")
+    upload = SimpleNamespace(filename="sales.csv", file=_Body(), read=_Body().read, size=10)
+    response = asyncio.run(server.upload_file(
+        None, server.Response(), file=upload, mode="stream", persist=None, durable=None, table=None,
+        append=False, partition_by=None, bucket_by=None, buckets=None, sort_by=None,
+    ))
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+class _Spark:
+    def __init__(self, files):
+        self.files = files
+
+    def table(self, name):
+        if self.files is None:
+            raise RuntimeError(f"Table or view not found: {name}")
+        return SimpleNamespace(inputFiles=lambda: self.files)
+
+
+@pytest.fixture
+def upload(tmp_path, monkeypatch):
+    path = tmp_path / "sales" / "upload.csv"
+    path.parent.mkdir()
+    path.write_text("id\n1\n")
+    monkeypatch.setattr(server, "INGEST_STORAGE", "local")
+
+    def fail(*args):
+        raise server.SchemaDriftError("sales", {"added": ["x"], "removed": [], "reordered": False})
+
+    monkeypatch.setattr(server, "_ingest_upload", fail)
+    return path
+
+
+def test_failed_stream_ingest_deletes_the_upload(upload, monkeypatch):
+    monkeypatch.setattr(server, "spark", _Spark(None))
+    with pytest.raises(server.SchemaDriftError):
+        server._ingest_stored_upload("sales", "stream", "file://" + str(upload), "NONE", False)
+    assert not upload.exists()
+
+
+def test_failed_ingest_keeps_a_file_the_table_reads(upload, monkeypatch):
+    uri = "file://" + str(upload)
+    monkeypatch.setattr(server, "spark", _Spark([uri]))
+    with pytest.raises(server.SchemaDriftError):
+        server._ingest_stored_upload("sales", "stream", uri, "NONE", False)
+    assert upload.exists()
@@ -2,6 +2,7 @@ import React, { useEffect, useRef, useState } from "react";
 import "./App.css";
 
 const API_BASE_URL = process.env.REACT_APP_API_BASE_URL || "http://localhost:8000";
+const JOB_POLL_INTERVAL_MS = 1000;
 
 // Modern color palette and styles
 const styles = {
@@ -189,6 +190,8 @@ function App() {
   const [statusMessage, setStatusMessage] = useState(null);
   const [isUploading, setIsUploading] = useState(false);
   const [isQuerying, setIsQuerying] = useState(false);
+  const [queryProgress, setQueryProgress] = useState(null);
+  const [approximate, setApproximate] = useState(false);
 
   // Autocomplete: catalog, suggestions, and editor refs
   const [tables, setTables] = useState([]);
@@ -209,19 +212,13 @@ function App() {
   useEffect(() => {
     const loadCatalog = async () => {
       try {
-        const res = await fetch(`${API_BASE_URL}/tables`);
+        const res = await fetch(`${API_BASE_URL}/schema`);
         const data = await res.json();
         if (res.ok && data.tables) {
           setTables(data.tables);
-          data.tables.forEach(async (t) => {
-            try {
-              const cr = await fetch(`${API_BASE_URL}/columns?table=${encodeURIComponent(t.name)}`);
-              const cd = await cr.json();
-              if (cr.ok && cd.columns) {
-                setColumnsByTable(prev => ({ ...prev, [t.name]: cd.columns.map(c => c.name) }));
-              }
-            } catch {}
-          });
+          setColumnsByTable(Object.fromEntries(
+            data.tables.map((t) => [t.name, t.columns.map((c) => c.name)])
+          ));
         }
       } catch {}
     };
@@ -276,15 +273,38 @@ function App() {
 
     const formData = new FormData();
     formData.append("query", query);
+    if (approximate) {
+      formData.append("approx", "true");
+    }
 
     try {
       setError(null);
       setStatusMessage(null);
       setIsQuerying(true);
-      const response = await fetch(`${API_BASE_URL}/query`, {
+      setQueryProgress(null);
+      // Submit as a background job and poll, so long queries don't hit HTTP timeouts
+      const submit = await fetch(`${API_BASE_URL}/jobs`, {
         method: "POST",
         body: formData,
       });
+      const job = await submit.json();
+      if (!submit.ok) {
+        throw new Error(job.detail || job.error || "Failed to submit query");
+      }
+
+      let status = job.status;
+      while (!["succeeded", "failed", "cancelled"].includes(status)) {
+        await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+        const poll = await fetch(`${API_BASE_URL}/jobs/${job.jobId}`);
+        const snapshot = await poll.json();
+        if (!poll.ok) {
+          throw new Error(snapshot.detail || "Failed to check query status");
+        }
+        status = snapshot.status;
+        setQueryProgress(snapshot.progress);
+      }
+
+      const response = await fetch(`${API_BASE_URL}/jobs/${job.jobId}/result`);
       const data = await response.json();
       if (!response.ok) {
         throw new Error(data.detail || data.error || "Failed to run query");
@@ -299,6 +319,7 @@ function App() {
       setQueryResult(null);
     } finally {
       setIsQuerying(false);
+      setQueryProgress(null);
     }
   };
 
@@ -615,6 +636,15 @@ function App() {
             </div>
           ) : null}
 
+          <label style={{ display: 'flex', alignItems: 'center', gap: '8px', marginTop: '12px', color: '#374151', fontSize: '14px' }}>
+            <input
+              type="checkbox"
+              checked={approximate}
+              onChange={(e) => setApproximate(e.target.checked)}
+            />
+            Approximate (sampled, faster on large tables)
+          </label>
+
           <button
             className="button"
             onClick={runQuery}
@@ -630,6 +660,7 @@ function App() {
               <>
                 <i className="fas fa-spinner" style={styles.spinner}></i>
                 Running Query...
+                {queryProgress?.tasksTotal ? ` ${queryProgress.tasksCompleted}/${queryProgress.tasksTotal} tasks` : ''}
               </>
             ) : (
               <>
@@ -663,6 +694,16 @@ function App() {
                     Showing up to {queryResult.limit} rows
                   </p>
                 )}
+                {queryResult.approximate && (
+                  <p className="text-center" style={{ marginTop: '8px', color: '#6b7280', fontSize: '14px' }}>
+                    <i className="fas fa-info-circle" style={{ marginRight: '6px' }}></i>
+                    {queryResult.approximate.mode === 'sample'
+                      ? `Estimated from a ${(queryResult.approximate.sampleFraction * 100).toPrecision(2)}% sample of ${queryResult.approximate.sampledTable}`
+                      : queryResult.approximate.mode === 'sketch'
+                        ? `Distinct counts are estimates within ±${(queryResult.approximate.distinctRsd * 196).toPrecision(2)}% (95% confidence)`
+                        : `Exact result: ${queryResult.approximate.reason}`}
+                  </p>
+                )}
               </>
             ) : (
               <div className="text-center" style={{
@@ -11,8 +11,7 @@ CREATE TABLE sales (
 USING csv
 OPTIONS (
     path 'file:///data/sales.csv',
-    header 'true',
-    inferSchema 'true'
+    header 'true'
 );
 
 -- query ตัวอย่าง
@@ -29,8 +28,7 @@ CREATE TABLE products (
 USING csv
 OPTIONS (
     path 'file:///data/products.csv',
-    header 'true',
-    inferSchema 'true'
+    header 'true'
 );
 
 SELECT s.product, p.category, SUM(s.amount) AS total_sales